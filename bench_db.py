@@ -0,0 +1,61 @@
+import os, random, sys, tempfile, time
+from db import Database, Conversation, Group, Tag
+
+# Times the queries behind the tree, tag list and tagging dialogs on a
+# generated archive, before and after the index migration (schema_2).
+#   python bench_db.py [conversations]
+
+def populate(database, conversations, groups=200, tags=50):
+    cursor = database.conn.cursor()
+    cursor.executemany("INSERT INTO groups (name) VALUES (?)", [(f"group {i}",) for i in range(groups - 1)])
+    cursor.executemany("INSERT INTO tag (name) VALUES (?)", [(f"tag {i}",) for i in range(tags)])
+    payload = os.urandom(2048)
+    cursor.executemany("INSERT INTO conversations (title, group_id, data, salt, deleted) VALUES (?, ?, ?, ?, ?)",
+                       [(f"conversation {i}", random.randint(1, groups), payload, "salt", int(random.random() < 0.05)) for i in range(conversations)])
+    cursor.executemany("INSERT INTO conversation_tag (conversation_id, tag_id) VALUES (?, ?)",
+                       [(i, tag_id) for i in range(1, conversations + 1) for tag_id in random.sample(range(1, tags + 1), 2)])
+    database.conn.commit()
+
+def timed(label, fn, results):
+    started = time.perf_counter()
+    fn()
+    elapsed = (time.perf_counter() - started) * 1000
+    results.setdefault(label, []).append(elapsed)
+
+def run_queries(database, results):
+    cursor = database.conn.cursor()
+    group_ids = [group.id for group in Group.get_all(cursor)]
+    tag_ids = [tag.id for tag in Tag.get_all(cursor)]
+
+    timed("Group.get_tree", lambda: Group.get_tree(cursor), results)
+    timed("get_by_group_id, every group", lambda: [Conversation.get_by_group_id(group_id, cursor) for group_id in group_ids], results)
+    timed("get_by_tag_id, every tag", lambda: [Conversation.get_by_tag_id(tag_id, cursor) for tag_id in tag_ids], results)
+    timed("Tag.get_all", lambda: Tag.get_all(cursor), results)
+    timed("tags grouped by conversation", lambda: Tag.get_all_tags_grouped_by_conversation(cursor), results)
+
+    def change_tags():
+        for conversation_id in range(1, 501):
+            Conversation.change_tag(conversation_id, random.sample(tag_ids, 2), cursor)
+        database.conn.rollback()
+    timed("change_tag x500", change_tags, results)
+
+if __name__ == "__main__":
+    conversations = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        database = Database(os.path.join(tmp, "bench.chdb"))
+        database.create_db()
+        database.create_table()
+        database.migrate(target=1)
+        populate(database, conversations)
+
+        before, after = {}, {}
+        run_queries(database, before)
+        database.migrate(target=2)
+        run_queries(database, after)
+        database.close()
+
+    print(f"{conversations} conversations, ms")
+    print(f"{'query':<32}{'schema 1':>12}{'schema 2':>12}")
+    for label in before:
+        print(f"{label:<32}{before[label][0]:>12.1f}{after[label][0]:>12.1f}")
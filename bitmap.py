@@ -0,0 +1,104 @@
+from collections import defaultdict
+
+# Tag membership as bitsets, one per tag, bit n set when conversation n has
+# the tag. Python ints do the AND/OR/NOT over a whole archive in one C loop,
+# and a combined result is turned into bytes once so checking a single
+# conversation is an index and a shift.
+
+MATCH_ALL = "all"
+MATCH_ANY = "any"
+
+class TagQuery:
+    def __init__(self, include=(), exclude=(), mode=MATCH_ALL, group_ids=()):
+        self.include = frozenset(include)
+        self.exclude = frozenset(exclude)
+        self.mode = mode
+        self.group_ids = frozenset(group_ids)
+
+    def is_empty(self):
+        return not self.include and not self.exclude and not self.group_ids
+
+    def __eq__(self, other):
+        return isinstance(other, TagQuery) and \
+            (self.include, self.exclude, self.mode, self.group_ids) == (other.include, other.exclude, other.mode, other.group_ids)
+
+    def __hash__(self):
+        return hash((self.include, self.exclude, self.mode, self.group_ids))
+
+
+class TagMatch:
+    # result of a TagQuery, include is None when any conversation qualifies
+    def __init__(self, include, exclude):
+        self.include = self._to_bytes(include) if include != None else None
+        self.exclude = self._to_bytes(exclude)
+
+    @staticmethod
+    def _to_bytes(bitmap):
+        return bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+
+    @staticmethod
+    def _test(bits, conversation_id):
+        byte = conversation_id >> 3
+        return byte < len(bits) and (bits[byte] >> (conversation_id & 7)) & 1 == 1
+
+    def __contains__(self, conversation_id):
+        if self.include != None and not self._test(self.include, conversation_id):
+            return False
+        return not self._test(self.exclude, conversation_id)
+
+
+class TagBitmaps:
+    def __init__(self, bitmaps=None):
+        self.bitmaps = bitmaps if bitmaps != None else {}
+
+    @classmethod
+    def load(cls, cursor):
+        # set bits in a bytearray per tag and convert once, or-ing ints one
+        # conversation at a time would copy the whole bitmap every row
+        cursor.execute("SELECT ct.tag_id, ct.conversation_id FROM conversation_tag ct INNER JOIN conversations c ON c.id=ct.conversation_id WHERE c.deleted=0")
+        buffers = defaultdict(bytearray)
+        for tag_id, conversation_id in cursor.fetchall():
+            buffer = buffers[tag_id]
+            byte = conversation_id >> 3
+            if byte >= len(buffer):
+                buffer.extend(bytes(byte - len(buffer) + 1))
+            buffer[byte] |= 1 << (conversation_id & 7)
+        return cls({tag_id: int.from_bytes(buffer, 'little') for tag_id, buffer in buffers.items()})
+
+    def tags_of(self, conversation_id):
+        return [tag_id for tag_id, bitmap in self.bitmaps.items() if (bitmap >> conversation_id) & 1]
+
+    def set_tags(self, conversation_id, tag_ids):
+        bit = 1 << conversation_id
+        tag_ids = set(tag_ids)
+        for tag_id in list(self.bitmaps):
+            if tag_id not in tag_ids and self.bitmaps[tag_id] & bit:
+                self.bitmaps[tag_id] &= ~bit
+        for tag_id in tag_ids:
+            self.bitmaps[tag_id] = self.bitmaps.get(tag_id, 0) | bit
+
+    def remove_conversations(self, conversation_ids):
+        mask = 0
+        for conversation_id in conversation_ids:
+            mask |= 1 << conversation_id
+        for tag_id in self.bitmaps:
+            self.bitmaps[tag_id] &= ~mask
+
+    def remove_tags(self, tag_ids):
+        for tag_id in tag_ids:
+            self.bitmaps.pop(tag_id, None)
+
+    def match(self, query):
+        include = None
+        if query.include:
+            bitmaps = [self.bitmaps.get(tag_id, 0) for tag_id in query.include]
+            include = bitmaps[0]
+            for bitmap in bitmaps[1:]:
+                if query.mode == MATCH_ALL:
+                    include &= bitmap
+                else:
+                    include |= bitmap
+        exclude = 0
+        for tag_id in query.exclude:
+            exclude |= self.bitmaps.get(tag_id, 0)
+        return TagMatch(include, exclude)
@@ -1,16 +1,127 @@
-from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes, hmac
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-import secrets, base64
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from collections import OrderedDict
+import secrets, base64, threading, unicodedata, os, zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# key derivation schemes, stored per conversation row (conversations.kdf) and
+# as the scheme for new rows (metadata "kdf_version").
+# pbkdf2 is for stretching passwords. conversation keys are derived from the
+# random master key, which needs no stretching, so hkdf is enough there.
+KDF_PBKDF2 = 1
+KDF_HKDF = 2
+
+# payload formats, the first byte of what's stored.
+# rows written before formats existed are base64 fernet tokens, which always
+# start with "g". everything newer is raw bytes: the format byte, a 12 byte
+# nonce, then aes-gcm over the compressed utf-8 text, with the format byte
+# as associated data. zstd is used when the zstandard package is installed.
+FORMAT_FERNET = ord("g")
+FORMAT_RAW = 1
+FORMAT_ZLIB = 2
+FORMAT_ZSTD = 3
+NONCE_LENGTH = 12
+
+# big conversations are cut into chunks sealed one by one, so they can be
+# decrypted and shown a piece at a time:
+#   header:  format byte, 8 byte nonce prefix
+#   chunk:   4 byte length, aes-gcm of (compression byte, compressed text)
+# a chunk's nonce is the prefix and its 4 byte counter. the header, the
+# counter and a last-chunk flag are associated data, so chunks can't be
+# reordered, dropped, cut off at the end or moved to another payload.
+FORMAT_CHUNKED = 4
+NONCE_PREFIX_LENGTH = 8
+CHUNK_CHARS = 64 * 1024
+CHUNKED_THRESHOLD = 4 * CHUNK_CHARS
+
+# conversations stored per message (messages table) keep only this marker and
+# 16 random bytes in conversations.data. it's new on every change, so it
+# still tells readers whether the conversation changed under them
+FORMAT_MESSAGES = 5
+
+def new_messages_marker():
+    return bytes([FORMAT_MESSAGES]) + os.urandom(16)
+
+def is_messages_marker(data):
+    return len(data) > 0 and data[0] == FORMAT_MESSAGES
+
+def is_legacy_payload(data):
+    return len(data) > 0 and data[0] in (FORMAT_FERNET, "g")
 
 class EncryptionWrapper:
-    def __init__(self, password, salt):
+    # derived wrappers for the unlocked session, keyed by (kdf, password, salt).
+    # bounded so a long session walking a big archive doesn't grow forever.
+    _cache = OrderedDict()
+    _cache_size = 256
+    _cache_lock = threading.Lock()
+
+    def __init__(self, password, salt, kdf=KDF_PBKDF2):
         self.password = password
         self.salt = salt
+        self.kdf = kdf
         self.key = self._derive_key()
+        self.cipher_suite = Fernet(base64.urlsafe_b64encode(self.key))
+        # fernet splits the key into signing and encryption halves, aes-gcm
+        # gets a key of its own rather than reusing the same bytes
+        self.aead = AESGCM(HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b'chatgpt-history payload',
+        ).derive(self.key))
+
+    @classmethod
+    def get(cls, password, salt, kdf=KDF_PBKDF2):
+        """Return a cached wrapper for (kdf, password, salt), deriving the key only on a miss."""
+        cache_key = (kdf, password, salt)
+        with cls._cache_lock:
+            wrapper = cls._cache.get(cache_key)
+            if wrapper is not None:
+                cls._cache.move_to_end(cache_key)
+                return wrapper
+
+        # derive outside the lock, pbkdf2 is the slow part
+        wrapper = cls(password, salt, kdf)
+        with cls._cache_lock:
+            cls._cache[cache_key] = wrapper
+            cls._cache.move_to_end(cache_key)
+            while len(cls._cache) > cls._cache_size:
+                cls._cache.popitem(last=False)
+        return wrapper
+
+    @classmethod
+    def clear_cache(cls):
+        with cls._cache_lock:
+            for wrapper in cls._cache.values():
+                wrapper.wipe()
+            cls._cache.clear()
+
+    def wipe(self):
+        # drop references to key material, python can't zero immutable bytes
+        self.key = None
+        self.password = None
+        self.cipher_suite = None
+        self.aead = None
 
     def _derive_key(self):
         salt = self.salt.encode('utf-8')
+        if self.kdf == KDF_HKDF:
+            kdf = HKDF(
+                algorithm=hashes.SHA256(),
+                length=32,
+                salt=salt,
+                info=b'chatgpt-history conversation',
+            )
+            return kdf.derive(self.password.encode('utf-8'))
+
         kdf = PBKDF2HMAC(
             algorithm=hashes.SHA256(),
             length=32,
@@ -19,17 +130,99 @@ class EncryptionWrapper:
         )
         return kdf.derive(self.password.encode('utf-8'))
 
+    @staticmethod
+    def _compress(data):
+        if zstandard != None:
+            compression, compressed = FORMAT_ZSTD, zstandard.ZstdCompressor(level=3).compress(data)
+        else:
+            compression, compressed = FORMAT_ZLIB, zlib.compress(data, 6)
+        # short messages can come out bigger
+        if len(compressed) >= len(data):
+            return FORMAT_RAW, data
+        return compression, compressed
+
+    @staticmethod
+    def _decompress(compression, data):
+        if compression == FORMAT_ZLIB:
+            return zlib.decompress(data)
+        if compression == FORMAT_ZSTD:
+            if zstandard == None:
+                raise RuntimeError("this conversation was compressed with zstd, install the zstandard package to open it")
+            return zstandard.ZstdDecompressor().decompress(data)
+        if compression == FORMAT_RAW:
+            return bytes(data)
+        raise InvalidToken
+
+    def _open(self, nonce, sealed, associated_data):
+        try:
+            return self.aead.decrypt(nonce, sealed, associated_data)
+        except InvalidTag:
+            # callers already handle a wrong key or a damaged row as InvalidToken
+            raise InvalidToken
+
     def encrypt(self, plaintext):
-        base64_key = base64.urlsafe_b64encode(self.key)
-        cipher_suite = Fernet(base64_key)
-        ciphertext = cipher_suite.encrypt(plaintext.encode('utf-8'))
-        return ciphertext
+        if len(plaintext) > CHUNKED_THRESHOLD:
+            return self.encrypt_chunked(plaintext)
+        payload_format, compressed = self._compress(plaintext.encode('utf-8'))
+        header = bytes([payload_format])
+        nonce = os.urandom(NONCE_LENGTH)
+        return header + nonce + self.aead.encrypt(nonce, compressed, header)
+
+    def encrypt_chunked(self, plaintext, chunk_chars=CHUNK_CHARS):
+        # encoded and compressed a chunk at a time, never the whole text at once
+        header = bytes([FORMAT_CHUNKED]) + os.urandom(NONCE_PREFIX_LENGTH)
+        parts = [header]
+        starts = range(0, max(len(plaintext), 1), chunk_chars)
+        for counter, start in enumerate(starts):
+            final = start + chunk_chars >= len(plaintext)
+            compression, compressed = self._compress(plaintext[start:start + chunk_chars].encode('utf-8'))
+            position = counter.to_bytes(4, 'big')
+            sealed = self.aead.encrypt(header[1:] + position, bytes([compression]) + compressed, header + position + bytes([final]))
+            parts.append(len(sealed).to_bytes(4, 'big'))
+            parts.append(sealed)
+        return b"".join(parts)
+
+    def decrypt(self, ciphertext):
+        return "".join(self.decrypt_iter(ciphertext))
+
+    def decrypt_iter(self, ciphertext):
+        # the text in pieces as they're decrypted, one piece per chunk for the
+        # chunked format and the whole text at once for everything else
+        if isinstance(ciphertext, str):
+            ciphertext = ciphertext.encode('utf-8')
+        if is_legacy_payload(ciphertext):
+            yield self.cipher_suite.decrypt(ciphertext).decode('utf-8')
+            return
+
+        payload_format = ciphertext[0] if ciphertext else None
+        if payload_format in (FORMAT_RAW, FORMAT_ZLIB, FORMAT_ZSTD):
+            header = ciphertext[:1]
+            nonce = ciphertext[1:1 + NONCE_LENGTH]
+            data = self._open(nonce, ciphertext[1 + NONCE_LENGTH:], header)
+            yield self._decompress(payload_format, data).decode('utf-8')
+            return
+        if payload_format != FORMAT_CHUNKED:
+            raise InvalidToken
 
-    def decrypt(self, ciphertext):        
-        base64_key = base64.urlsafe_b64encode(self.key)
-        cipher_suite = Fernet(base64_key)
-        plaintext = cipher_suite.decrypt(ciphertext).decode('utf-8')
-        return plaintext
+        view = memoryview(ciphertext)
+        header = bytes(view[:1 + NONCE_PREFIX_LENGTH])
+        offset = len(header)
+        counter = 0
+        final = False
+        while not final:
+            if offset + 4 > len(view):
+                # ran out before the chunk flagged as the last one, cut off
+                raise InvalidToken
+            length = int.from_bytes(view[offset:offset + 4], 'big')
+            offset += 4
+            sealed = view[offset:offset + length]
+            offset += length
+            final = offset >= len(view)
+            position = counter.to_bytes(4, 'big')
+            data = self._open(header[1:] + position, sealed, header + position + bytes([final]))
+            # chunks are cut on characters, every one decodes on its own
+            yield self._decompress(data[0], memoryview(data)[1:]).decode('utf-8')
+            counter += 1
 
     @classmethod
     def generate_salt(cls, length=16):
@@ -46,6 +239,36 @@ class EncryptionWrapper:
         key = ''.join(secrets.choice(charset) for _ in range(int(length)))
         return key
 
+class ContentHasher:
+    # keyed hash of a conversation's text, for spotting re-imports without
+    # decrypting anything. keyed with the master key so equal hashes in the
+    # database say nothing about the text to someone without it
+    def __init__(self, password):
+        kdf = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b'chatgpt-history content',
+        )
+        self.key = kdf.derive(password.encode('utf-8'))
+
+    @staticmethod
+    def normalize(text):
+        # the same conversation exported twice can differ in line endings,
+        # trailing spaces and unicode composition
+        text = unicodedata.normalize("NFC", text.replace("\r\n", "\n"))
+        return "\n".join(line.rstrip() for line in text.split("\n")).strip()
+
+    def digest(self, text, normalize=True):
+        # normalize=False tells apart any change at all, e.g. a single message
+        # that was edited
+        h = hmac.HMAC(self.key, hashes.SHA256())
+        h.update((self.normalize(text) if normalize else text).encode('utf-8'))
+        return h.finalize()
+
+    def wipe(self):
+        self.key = None
+
 import ctypes
 import sys
 
@@ -68,6 +291,8 @@ class SecureString:
         if not self._is_wiped:
             libc.memset(self._buffer, 0, len(self._buffer))
             self._is_wiped = True
+            # keys derived from this secret go with it
+            EncryptionWrapper.clear_cache()
     
 ## main
 if __name__ == '__main__':
@@ -1,4 +1,7 @@
-import sqlite3
+import sqlite3, threading
+
+# bump together with a new Database.schema_<n> method
+SCHEMA_VERSION = 6
 
 class Database:
     _instance = None
@@ -19,6 +22,7 @@ class Database:
         self.db = db
         self.conn = None
         self.cursor = None
+        self._local = threading.local()
 
     def create_db(self):
         self.conn = sqlite3.connect(self.db)
@@ -74,10 +78,101 @@ class Database:
     def init(self):
         self.create_db()
         self.create_table()
+        self.migrate()
 
     def connect(self):
         if not self.conn:
             self.conn = sqlite3.connect(self.db)
+            self.migrate()
+
+    # Schema changes after the first release live in schema_<n> methods and run
+    # in order, once, for new and existing databases alike. The version reached
+    # is kept in metadata "schema_version".
+    def migrate(self, target=SCHEMA_VERSION):
+        cursor = self.conn.cursor()
+        version = int(Metadata.get_value("schema_version", cursor, 0))
+        for number in range(version + 1, target + 1):
+            getattr(self, f"schema_{number}")(cursor)
+            Metadata.add(Metadata(None, "schema_version", str(number)), cursor)
+            self.conn.commit()
+
+    def schema_1(self, cursor):
+        # key scheme per row, search index and render cache.
+        # some databases got these columns before schema_version existed
+        cursor.execute("PRAGMA table_info(conversations)")
+        columns = [row[1] for row in cursor.fetchall()]
+        if "kdf" not in columns:
+            # rows written before the kdf column existed all used pbkdf2
+            cursor.execute("ALTER TABLE conversations ADD COLUMN kdf INTEGER DEFAULT 1")
+        if "indexed" not in columns:
+            cursor.execute("ALTER TABLE conversations ADD COLUMN indexed INTEGER DEFAULT 0")
+
+        # html is encrypted with the conversation's own key
+        cursor.execute("""CREATE TABLE IF NOT EXISTS render_cache (
+                                conversation_id INTEGER PRIMARY KEY,
+                                data_hash TEXT NOT NULL,
+                                html BLOB NOT NULL,
+                                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP)""")
+
+        # blinded words, see search.py
+        cursor.execute("""CREATE TABLE IF NOT EXISTS search_token (
+                                token BLOB NOT NULL,
+                                conversation_id INTEGER NOT NULL)""")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_search_token_token ON search_token (token)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_search_token_conversation_id ON search_token (conversation_id)")
+
+    def schema_2(self, cursor):
+        # the tree query and the per group lookups are answered from the index alone
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_group ON conversations (group_id, deleted, id, title)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_deleted ON conversations (deleted)")
+
+        # older versions could tag a conversation twice, keep the first one
+        cursor.execute("DELETE FROM conversation_tag WHERE id NOT IN (SELECT MIN(id) FROM conversation_tag GROUP BY conversation_id, tag_id)")
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_conversation_tag_conversation ON conversation_tag (conversation_id, tag_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversation_tag_tag ON conversation_tag (tag_id, conversation_id)")
+
+    def schema_3(self, cursor):
+        # keyed hash of the plaintext, imports skip what's already there.
+        # existing rows are hashed in the background (maintenance.py)
+        cursor.execute("PRAGMA table_info(conversations)")
+        columns = [row[1] for row in cursor.fetchall()]
+        if "content_hash" not in columns:
+            cursor.execute("ALTER TABLE conversations ADD COLUMN content_hash BLOB")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_content_hash ON conversations (content_hash) WHERE content_hash IS NOT NULL")
+
+    def schema_4(self, cursor):
+        # one row per turn, body encrypted with the conversation's key.
+        # content_hash is a keyed hash of the exact body, saves only rewrite
+        # messages whose hash changed. see messages.py
+        cursor.execute("""CREATE TABLE IF NOT EXISTS messages (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                conversation_id INTEGER NOT NULL,
+                                ordinal INTEGER NOT NULL,
+                                role TEXT,
+                                data BLOB NOT NULL,
+                                content_hash BLOB)""")
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_conversation ON messages (conversation_id, ordinal)")
+
+    def schema_5(self, cursor):
+        # saved versions of a conversation, a full snapshot now and then and
+        # encrypted deltas in between. kdf per row, the key may have changed
+        # since. see revisions.py
+        cursor.execute("""CREATE TABLE IF NOT EXISTS revisions (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                conversation_id INTEGER NOT NULL,
+                                number INTEGER NOT NULL,
+                                snapshot INTEGER NOT NULL,
+                                data BLOB NOT NULL,
+                                kdf INTEGER NOT NULL,
+                                content_hash BLOB,
+                                created_at DATETIME DEFAULT CURRENT_TIMESTAMP)""")
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_revisions_conversation ON revisions (conversation_id, number)")
+
+    def schema_6(self, cursor):
+        # the search index now has single character words, everything is
+        # indexed again in the background (SearchIndexBackfill). until then
+        # search falls back to scanning
+        cursor.execute("UPDATE conversations SET indexed=0")
     
     def get_cursor(self):
         if not self.cursor:
@@ -85,6 +180,14 @@ class Database:
             self.cursor = self.conn.cursor()
         return self.cursor
     
+    def get_thread_connection(self):
+        # sqlite connections can't cross threads, background workers get their own
+        conn = getattr(self._local, "conn", None)
+        if conn == None:
+            conn = sqlite3.connect(self.db, timeout=30)
+            self._local.conn = conn
+        return conn
+
     def close(self):
         self.conn.close()
 
@@ -99,6 +202,14 @@ class Metadata:
         cursor.execute("SELECT id, key, value FROM metadata WHERE key=?", (key,))
         row = cursor.fetchone()
         return cls(*row)
+
+    @classmethod
+    def get_value(cls, key, cursor, default=None):
+        cursor.execute("SELECT value FROM metadata WHERE key=?", (key,))
+        row = cursor.fetchone()
+        if row == None:
+            return default
+        return row[0]
     
     @classmethod
     def add(cls, metadata, cursor):
@@ -106,13 +217,14 @@ class Metadata:
         cursor.execute("INSERT INTO metadata (key, value, created_at, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP) ON CONFLICT(key) DO UPDATE SET value=?, updated_at=CURRENT_TIMESTAMP", (metadata.key, metadata.value, metadata.value))
 
 class Conversation:
-    def __init__(self, id, title, group_id, data, abstract, salt, tags = []):
+    def __init__(self, id, title, group_id, data, abstract, salt, kdf = 1, tags = []):
         self.title = title
         self.group_id = group_id
         self.data = data
         self.abstract = abstract
         self.id = id
         self.salt = salt
+        self.kdf = kdf
         self.tags = tags
     
     def __str__(self):
@@ -123,40 +235,58 @@ class Conversation:
 
     @classmethod
     def get_all(cls, cursor):
-        cursor.execute("SELECT id, title, group_id, data, abstract, salt FROM conversations WHERE deleted=0")
+        cursor.execute("SELECT id, title, group_id, data, abstract, salt, kdf FROM conversations WHERE deleted=0")
         rows = cursor.fetchall()
         return [cls(*row) for row in rows]
 
     @classmethod
     def get_all_with_pagination(cls, cursor, page=1, per_page=10):
-        cursor.execute("SELECT id, title, group_id, data, abstract, salt FROM conversations WHERE deleted=0 ORDER BY id DESC LIMIT ? OFFSET ?", (per_page, (page-1)*per_page))
+        cursor.execute("SELECT id, title, group_id, data, abstract, salt, kdf FROM conversations WHERE deleted=0 ORDER BY id DESC LIMIT ? OFFSET ?", (per_page, (page-1)*per_page))
         rows = cursor.fetchall()
         return [cls(*row) for row in rows]
 
     @classmethod
     def get_by_id(cls, id, cursor):
-        cursor.execute("SELECT id, title, group_id, data, abstract, salt FROM conversations WHERE id=? AND deleted=0", (id,))
+        cursor.execute("SELECT id, title, group_id, data, abstract, salt, kdf FROM conversations WHERE id=? AND deleted=0", (id,))
         row = cursor.fetchone()
         return cls(*row)
     
     @classmethod
     def get_by_group_id(cls, group_id, cursor):
-        cursor.execute("SELECT id, title, group_id, '', abstract, salt FROM conversations WHERE group_id=? AND deleted=0", (group_id,))
+        cursor.execute("SELECT id, title, group_id, '', abstract, salt, kdf FROM conversations WHERE group_id=? AND deleted=0", (group_id,))
         rows = cursor.fetchall()
         return [cls(*row) for row in rows]
     
     @classmethod
     def get_by_tag_id(cls, tag_id, cursor):
-        cursor.execute("SELECT c.id, c.title, c.group_id, c.data, c.abstract, c.salt FROM conversations c INNER JOIN conversation_tag ct ON c.id=ct.conversation_id WHERE ct.tag_id=? AND c.deleted=0", (tag_id,))
+        cursor.execute("SELECT c.id, c.title, c.group_id, c.data, c.abstract, c.salt, c.kdf FROM conversations c INNER JOIN conversation_tag ct ON c.id=ct.conversation_id WHERE ct.tag_id=? AND c.deleted=0", (tag_id,))
         rows = cursor.fetchall()
         return [cls(*row) for row in rows]
     
     @classmethod
     def add(cls, conversation, cursor):
-        cursor.execute("INSERT INTO conversations (title, group_id, data, abstract, salt, created_at, updated_at) VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)", (conversation.title, conversation.group_id, conversation.data, conversation.abstract, conversation.salt))
+        cursor.execute("INSERT INTO conversations (title, group_id, data, abstract, salt, kdf, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)", (conversation.title, conversation.group_id, conversation.data, conversation.abstract, conversation.salt, conversation.kdf))
         
         return cursor.lastrowid
     
+    @classmethod
+    def add_many(cls, conversations, cursor, created_at=None, content_hashes=None):
+        # one statement for a whole import, returns the new ids in order.
+        # the caller holds the write lock (BEGIN IMMEDIATE) so nothing else
+        # can take ids in between. created_at and content_hashes optionally
+        # hold a value per conversation, created_at None is now
+        if created_at == None:
+            created_at = [None] * len(conversations)
+        if content_hashes == None:
+            content_hashes = [None] * len(conversations)
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM conversations")
+        last_id = cursor.fetchone()[0]
+        cursor.executemany("INSERT INTO conversations (title, group_id, data, abstract, salt, kdf, content_hash, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP), CURRENT_TIMESTAMP)",
+                           [(conversation.title, conversation.group_id, conversation.data, conversation.abstract, conversation.salt, conversation.kdf, content_hash, created)
+                            for conversation, created, content_hash in zip(conversations, created_at, content_hashes)])
+        cursor.execute("SELECT id FROM conversations WHERE id>? ORDER BY id", (last_id,))
+        return [row[0] for row in cursor.fetchall()]
+
     @classmethod
     def save(cls, conversation, cursor):
         cursor.execute("INSERT INTO conversations (title, group_id, data, abstract, created_at, updated_at) VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)", (conversation.title, conversation.group_id, conversation.data, conversation.abstract, conversation.salt))
@@ -167,7 +297,7 @@ class Conversation:
 
     @classmethod
     def update(cls, conversation, cursor):
-        cursor.execute("UPDATE conversations SET title=?, group_id=?, data=?, abstract=?, salt=?, updated_at=CURRENT_TIMESTAMP WHERE id=?", (conversation.title, conversation.group_id, conversation.data, conversation.abstract, conversation.salt, conversation.id))
+        cursor.execute("UPDATE conversations SET title=?, group_id=?, data=?, abstract=?, salt=?, kdf=?, updated_at=CURRENT_TIMESTAMP WHERE id=?", (conversation.title, conversation.group_id, conversation.data, conversation.abstract, conversation.salt, conversation.kdf, conversation.id))
     
     @classmethod
     def update_title(cls, conversation_id, title, cursor):
@@ -178,34 +308,210 @@ class Conversation:
         cursor.execute("UPDATE conversations SET abstract=?, updated_at=CURRENT_TIMESTAMP WHERE id=?", (abstract, conversation_id))
 
     @classmethod
-    def update_data(cls, conversation_id, data, cursor):
-        cursor.execute("UPDATE conversations SET data=?, updated_at=CURRENT_TIMESTAMP WHERE id=?", (data, conversation_id))
+    def update_data(cls, conversation_id, data, kdf, cursor, content_hash=None):
+        # data and kdf travel together, the key scheme may change on save
+        cursor.execute("UPDATE conversations SET data=?, kdf=?, content_hash=?, updated_at=CURRENT_TIMESTAMP WHERE id=?", (data, kdf, content_hash, conversation_id))
+
+    @classmethod
+    def get_content_hashes(cls, cursor):
+        # every known content hash, what an import can skip without asking again
+        cursor.execute("SELECT content_hash FROM conversations WHERE content_hash IS NOT NULL AND deleted=0")
+        return set(row[0] for row in cursor.fetchall())
+
+    @classmethod
+    def has_content_hash(cls, content_hash, cursor):
+        cursor.execute("SELECT 1 FROM conversations WHERE content_hash=? AND deleted=0 LIMIT 1", (content_hash,))
+        return cursor.fetchone() != None
     
     @classmethod
     def delete(cls, id, cursor):
         cursor.execute("UPDATE conversations SET deleted=1 WHERE id=?", (id,))
+        cursor.execute("DELETE FROM search_token WHERE conversation_id=?", (id,))
+        RenderedHtml.delete(id, cursor)
         
     
     @classmethod
     def add_tag(cls, conversation_id, tag_id, cursor):
-        cursor.execute("INSERT INTO conversation_tag (conversation_id, tag_id) VALUES (?, ?)", (conversation_id, tag_id))
+        cursor.execute("INSERT OR IGNORE INTO conversation_tag (conversation_id, tag_id) VALUES (?, ?)", (conversation_id, tag_id))
 
     # tag_ids is a list of tag ids
     @classmethod
     def change_tag(cls, conversation_id, tag_ids, cursor):
         cursor.execute("DELETE FROM conversation_tag WHERE conversation_id=?", (conversation_id,))
-        for tag_id in tag_ids:
-            cursor.execute("INSERT INTO conversation_tag (conversation_id, tag_id) VALUES (?, ?)", (conversation_id, tag_id))
+        cursor.executemany("INSERT OR IGNORE INTO conversation_tag (conversation_id, tag_id) VALUES (?, ?)", [(conversation_id, tag_id) for tag_id in tag_ids])
 
     @classmethod
     def remove_tag(cls, conversation_id, tag_id, cursor):
         cursor.execute("DELETE FROM conversation_tag WHERE conversation_id=? AND tag_id=?", (conversation_id, tag_id))
         
         
+class ConversationHeader:
+    # everything about a conversation except its encrypted body, for lists and
+    # dialogs that only show titles. load() fetches the full conversation.
+    def __init__(self, id, title, group_id, created_at=None, updated_at=None):
+        self.id = id
+        self.title = title
+        self.group_id = group_id
+        self.created_at = created_at
+        self.updated_at = updated_at
+
+    def __str__(self):
+        return f"Conversation {self.id}: {self.title}"
+
+    def load(self, cursor):
+        return Conversation.get_by_id(self.id, cursor)
+
+    @classmethod
+    def get_all(cls, cursor):
+        cursor.execute("SELECT id, title, group_id, created_at, updated_at FROM conversations WHERE deleted=0")
+        rows = cursor.fetchall()
+        return [cls(*row) for row in rows]
+
+    @classmethod
+    def get_all_with_pagination(cls, cursor, page=1, per_page=10):
+        cursor.execute("SELECT id, title, group_id, created_at, updated_at FROM conversations WHERE deleted=0 ORDER BY id DESC LIMIT ? OFFSET ?", (per_page, (page-1)*per_page))
+        rows = cursor.fetchall()
+        return [cls(*row) for row in rows]
+
+    @classmethod
+    def get_by_id(cls, id, cursor):
+        cursor.execute("SELECT id, title, group_id, created_at, updated_at FROM conversations WHERE id=? AND deleted=0", (id,))
+        row = cursor.fetchone()
+        if row == None:
+            return None
+        return cls(*row)
+
+    @classmethod
+    def get_by_group_id(cls, group_id, cursor):
+        cursor.execute("SELECT id, title, group_id, created_at, updated_at FROM conversations WHERE group_id=? AND deleted=0", (group_id,))
+        rows = cursor.fetchall()
+        return [cls(*row) for row in rows]
+
+    @classmethod
+    def get_by_tag_id(cls, tag_id, cursor):
+        cursor.execute("SELECT c.id, c.title, c.group_id, c.created_at, c.updated_at FROM conversations c INNER JOIN conversation_tag ct ON c.id=ct.conversation_id WHERE ct.tag_id=? AND c.deleted=0", (tag_id,))
+        rows = cursor.fetchall()
+        return [cls(*row) for row in rows]
+
+
+class Message:
+    def __init__(self, conversation_id, ordinal, role, data, content_hash=None):
+        self.conversation_id = conversation_id
+        self.ordinal = ordinal
+        self.role = role
+        self.data = data
+        self.content_hash = content_hash
+
+    @classmethod
+    def get_range(cls, conversation_id, start, count, cursor):
+        # messages start .. start + count - 1 of a conversation, in order
+        cursor.execute("SELECT conversation_id, ordinal, role, data, content_hash FROM messages WHERE conversation_id=? AND ordinal>=? ORDER BY ordinal LIMIT ?", (conversation_id, start, count))
+        return [cls(*row) for row in cursor.fetchall()]
+
+    @classmethod
+    def get_by_conversation_id(cls, conversation_id, cursor):
+        cursor.execute("SELECT conversation_id, ordinal, role, data, content_hash FROM messages WHERE conversation_id=? ORDER BY ordinal", (conversation_id,))
+        return [cls(*row) for row in cursor.fetchall()]
+
+    @classmethod
+    def get_hashes(cls, conversation_id, cursor):
+        # {ordinal: (role, content_hash)}, enough to tell what a save changed
+        cursor.execute("SELECT ordinal, role, content_hash FROM messages WHERE conversation_id=?", (conversation_id,))
+        return {ordinal: (role, content_hash) for ordinal, role, content_hash in cursor.fetchall()}
+
+    @classmethod
+    def count(cls, conversation_id, cursor):
+        cursor.execute("SELECT COUNT(*) FROM messages WHERE conversation_id=?", (conversation_id,))
+        return cursor.fetchone()[0]
+
+    @classmethod
+    def data_size(cls, conversation_id, cursor):
+        # bytes of ciphertext over all the messages, without fetching any
+        cursor.execute("SELECT COALESCE(SUM(length(data)), 0) FROM messages WHERE conversation_id=?", (conversation_id,))
+        return cursor.fetchone()[0]
+
+    @classmethod
+    def save_many(cls, messages, cursor):
+        cursor.executemany("INSERT INTO messages (conversation_id, ordinal, role, data, content_hash) VALUES (?, ?, ?, ?, ?) ON CONFLICT(conversation_id, ordinal) DO UPDATE SET role=excluded.role, data=excluded.data, content_hash=excluded.content_hash",
+                           [(message.conversation_id, message.ordinal, message.role, message.data, message.content_hash) for message in messages])
+
+    @classmethod
+    def delete_from(cls, conversation_id, ordinal, cursor):
+        # drop the messages from ordinal on, after a save made the conversation shorter
+        cursor.execute("DELETE FROM messages WHERE conversation_id=? AND ordinal>=?", (conversation_id, ordinal))
+
+
+class Revision:
+    def __init__(self, conversation_id, number, snapshot, data, kdf, content_hash=None, created_at=None):
+        self.conversation_id = conversation_id
+        self.number = number
+        self.snapshot = snapshot
+        self.data = data
+        self.kdf = kdf
+        self.content_hash = content_hash
+        self.created_at = created_at
+
+    @classmethod
+    def add(cls, revision, cursor):
+        cursor.execute("INSERT INTO revisions (conversation_id, number, snapshot, data, kdf, content_hash, created_at) VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)",
+                       (revision.conversation_id, revision.number, int(revision.snapshot), revision.data, revision.kdf, revision.content_hash))
+
+    @classmethod
+    def get_headers(cls, conversation_id, cursor):
+        # newest first, without data, for listing
+        cursor.execute("SELECT conversation_id, number, snapshot, NULL, kdf, content_hash, created_at FROM revisions WHERE conversation_id=? ORDER BY number DESC", (conversation_id,))
+        return [cls(*row) for row in cursor.fetchall()]
+
+    @classmethod
+    def get_last(cls, conversation_id, cursor):
+        cursor.execute("SELECT conversation_id, number, snapshot, NULL, kdf, content_hash, created_at FROM revisions WHERE conversation_id=? ORDER BY number DESC LIMIT 1", (conversation_id,))
+        row = cursor.fetchone()
+        if row == None:
+            return None
+        return cls(*row)
+
+    @classmethod
+    def get_last_snapshot_number(cls, conversation_id, cursor):
+        cursor.execute("SELECT MAX(number) FROM revisions WHERE conversation_id=? AND snapshot=1", (conversation_id,))
+        return cursor.fetchone()[0]
+
+    @classmethod
+    def get_chain(cls, conversation_id, number, cursor):
+        # the last snapshot up to number and the deltas after it, in order
+        cursor.execute("""SELECT conversation_id, number, snapshot, data, kdf, content_hash, created_at FROM revisions
+                          WHERE conversation_id=? AND number<=? AND number>=(SELECT MAX(number) FROM revisions WHERE conversation_id=? AND number<=? AND snapshot=1)
+                          ORDER BY number""", (conversation_id, number, conversation_id, number))
+        return [cls(*row) for row in cursor.fetchall()]
+
+
+class RenderedHtml:
+    def __init__(self, conversation_id, data_hash, html):
+        self.conversation_id = conversation_id
+        self.data_hash = data_hash
+        self.html = html
+
+    @classmethod
+    def get_by_conversation_id(cls, conversation_id, cursor):
+        cursor.execute("SELECT conversation_id, data_hash, html FROM render_cache WHERE conversation_id=?", (conversation_id,))
+        row = cursor.fetchone()
+        if row == None:
+            return None
+        return cls(*row)
+
+    @classmethod
+    def save(cls, rendered, cursor):
+        cursor.execute("INSERT INTO render_cache (conversation_id, data_hash, html, updated_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP) ON CONFLICT(conversation_id) DO UPDATE SET data_hash=?, html=?, updated_at=CURRENT_TIMESTAMP", (rendered.conversation_id, rendered.data_hash, rendered.html, rendered.data_hash, rendered.html))
+
+    @classmethod
+    def delete(cls, conversation_id, cursor):
+        cursor.execute("DELETE FROM render_cache WHERE conversation_id=?", (conversation_id,))
+
+
 class Group:
-    def __init__(self, id, name):
+    def __init__(self, id, name, count = 0):
         self.id = id
         self.name = name
+        self.count = count
 
     def __str__(self):
         return f"Group {self.id}: {self.name}"
@@ -222,6 +528,48 @@ class Group:
         rows = cursor.fetchall()
         return [cls(*row) for row in rows]
     
+    @classmethod
+    def get_all_with_counts(cls, cursor):
+        cursor.execute("SELECT g.id, g.name, COUNT(c.id) FROM groups g LEFT JOIN conversations c ON c.group_id=g.id AND c.deleted=0 GROUP BY g.id ORDER BY g.id")
+        rows = cursor.fetchall()
+        return [cls(*row) for row in rows]
+
+    @classmethod
+    def get_conversation_page(cls, group_id, after_id, limit, cursor):
+        # the next page of a group's conversations by id, with their tag ids.
+        # returns [(conversation_id, title, [tag_id, ...]), ...]
+        cursor.execute("""SELECT c.id, c.title, group_concat(t.id)
+                          FROM conversations c
+                          LEFT JOIN conversation_tag ct ON ct.conversation_id=c.id
+                          LEFT JOIN tag t ON t.id=ct.tag_id
+                          WHERE c.group_id=? AND c.deleted=0 AND c.id>?
+                          GROUP BY c.id
+                          ORDER BY c.id
+                          LIMIT ?""", (group_id, after_id, limit))
+        return [(conversation_id, title, [int(tag_id) for tag_id in tag_ids.split(",")] if tag_ids else [])
+                for conversation_id, title, tag_ids in cursor.fetchall()]
+
+    @classmethod
+    def get_tree(cls, cursor):
+        # groups, their conversations and each conversation's tag ids in one query.
+        # returns [(group, [(conversation_id, title, [tag_id, ...]), ...]), ...]
+        cursor.execute("""SELECT g.id, g.name, c.id, c.title, group_concat(t.id)
+                          FROM groups g
+                          LEFT JOIN conversations c ON c.group_id=g.id AND c.deleted=0
+                          LEFT JOIN conversation_tag ct ON ct.conversation_id=c.id
+                          LEFT JOIN tag t ON t.id=ct.tag_id
+                          GROUP BY g.id, c.id
+                          ORDER BY g.id, c.id""")
+        tree = []
+        for group_id, group_name, conversation_id, title, tag_ids in cursor.fetchall():
+            if not tree or tree[-1][0].id != group_id:
+                tree.append((cls(group_id, group_name), []))
+            if conversation_id == None:
+                continue
+            tags = [int(tag_id) for tag_id in tag_ids.split(",")] if tag_ids else []
+            tree[-1][1].append((conversation_id, title, tags))
+        return tree
+
     @classmethod
     def add(cls, group, cursor):
         cursor.execute("INSERT INTO groups (name, created_at, updated_at) VALUES (?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)", (group.name,))
@@ -290,11 +638,13 @@ class Tag:
     
     @classmethod
     def delete(cls, id, cursor):
+        # untag every conversation in one statement, no need to list them first
+        cursor.execute("DELETE FROM conversation_tag WHERE tag_id=?", (id,))
         cursor.execute("DELETE FROM tag WHERE id=?", (id,))
         
 
     def add_tag_to_conversation(cls, conversation_id, tag_id, cursor):
-        cursor.execute("INSERT INTO conversation_tag (conversation_id, tag_id) VALUES (?, ?)", (conversation_id, tag_id))
+        cursor.execute("INSERT OR IGNORE INTO conversation_tag (conversation_id, tag_id) VALUES (?, ?)", (conversation_id, tag_id))
         
     
     def remove_tag_from_conversation(cls, conversation_id, tag_id, cursor):
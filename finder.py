@@ -0,0 +1,104 @@
+from array import array
+from itertools import compress, repeat
+import bisect, re
+
+# Find in the open conversation without walking the QTextDocument.
+# The document's plain text is folded once per render and re's literal
+# search finds the matches in C. A query that grows checks only the matches
+# it already had, when there are few enough of them for that to be cheaper.
+# Positions go in and out in QTextDocument units, which count characters
+# outside the BMP (emoji, mostly) twice.
+
+def fold(text):
+    # lower case without changing any offsets, the few characters whose
+    # lower case is longer are left as they are
+    folded = text.lower()
+    if len(folded) == len(text):
+        return folded
+    return "".join(char if len(char.lower()) != 1 else char.lower() for char in text)
+
+def overlaps_itself(query):
+    # "aa" or "abab", matches of it can overlap and non-overlapping matches
+    # aren't all of its occurrences
+    return any(query[:i] == query[-i:] for i in range(1, len(query)))
+
+
+class TextFinder:
+    # narrowing checks every previous match, past one match per this many
+    # characters searching the text again is faster
+    NARROW_DENSITY = 50
+
+    def __init__(self, text=""):
+        self.set_text(text)
+
+    def set_text(self, text):
+        self.text = fold(text)
+        # document positions of characters that take two of them
+        self.astral = array('I', (match.start() + i for i, match in enumerate(re.finditer("[\U00010000-\U0010FFFF]", text))))
+        self.query = ""
+        self.offsets = array('I')
+
+    def _position(self, offset):
+        # string offset to document position
+        if not self.astral:
+            return offset
+        low, high = 0, len(self.astral)
+        while low < high:
+            middle = (low + high) // 2
+            if self.astral[middle] - middle < offset:
+                low = middle + 1
+            else:
+                high = middle
+        return offset + low
+
+    def _offset(self, position):
+        return position - bisect.bisect_left(self.astral, position) if self.astral else position
+
+    def find(self, query):
+        # offsets of the matches, stepping over overlapping ones the way
+        # QTextDocument.find does. returns how many there are
+        query = fold(query)
+        previous = self.query
+        self.query = query
+        if not query:
+            self.offsets = array('I')
+        elif previous and query.startswith(previous) and not overlaps_itself(previous) \
+                and len(self.offsets) * self.NARROW_DENSITY < len(self.text):
+            offsets = compress(self.offsets, map(self.text.startswith, repeat(query), self.offsets))
+            if overlaps_itself(query):
+                kept = array('I')
+                end = 0
+                for offset in offsets:
+                    if offset >= end:
+                        kept.append(offset)
+                        end = offset + len(query)
+                self.offsets = kept
+            else:
+                self.offsets = array('I', offsets)
+        else:
+            self.offsets = array('I', map(re.Match.start, re.finditer(re.escape(query), self.text)))
+        return len(self.offsets)
+
+    def _match(self, i):
+        offset = self.offsets[i]
+        return self._position(offset), self._position(offset + len(self.query))
+
+    def between(self, start, end):
+        # [(start, end)] of the matches beginning in the position range
+        first = bisect.bisect_left(self.offsets, self._offset(start))
+        last = bisect.bisect_right(self.offsets, self._offset(end))
+        return [self._match(i) for i in range(first, last)]
+
+    def next(self, position):
+        # the first match starting at or after position, None past the last
+        i = bisect.bisect_left(self.offsets, self._offset(position))
+        if i == len(self.offsets):
+            return None
+        return self._match(i)
+
+    def previous(self, position):
+        # the last match starting before position
+        i = bisect.bisect_left(self.offsets, self._offset(position))
+        if i == 0:
+            return None
+        return self._match(i - 1)
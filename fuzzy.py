@@ -0,0 +1,82 @@
+from array import array
+from collections import Counter, defaultdict
+import heapq
+
+# Fuzzy title search over the titles already in memory.
+# Every title is split into trigrams of its words and the trigrams point back
+# at the titles. A query is scored against the titles sharing any trigram
+# with it, the best of those get a bonus when the query's characters show up
+# in order, so "prj rvw" still finds "Project review".
+
+def word_trigrams(word):
+    padded = f"  {word} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+def trigrams(text, cache=None):
+    # titles repeat a lot of words, cache is a dict shared across one build
+    grams = set()
+    for word in text.split():
+        if cache == None:
+            grams.update(word_trigrams(word))
+            continue
+        word_grams = cache.get(word)
+        if word_grams == None:
+            word_grams = cache[word] = word_trigrams(word)
+        grams.update(word_grams)
+    return grams
+
+def subsequence_score(query, title):
+    # 1 for a plain substring, less the more the characters are spread out,
+    # 0 when they don't all appear in order
+    if query in title:
+        return 1.0
+    position = 0
+    first = None
+    for char in query:
+        if char == " ":
+            continue
+        position = title.find(char, position)
+        if position < 0:
+            return 0.0
+        if first == None:
+            first = position
+        position += 1
+    if first == None:
+        return 0.0
+    return 0.5 * len(query.replace(" ", "")) / (position - first)
+
+
+class TitleIndex:
+    def __init__(self, titles):
+        # titles is a list of (conversation_id, casefolded title)
+        self.ids = array('q')
+        self.titles = []
+        self.sizes = array('H')
+        self.postings = defaultdict(lambda: array('I'))
+        cache = {}
+        for position, (conversation_id, title) in enumerate(titles):
+            grams = trigrams(title, cache)
+            self.ids.append(conversation_id)
+            self.titles.append(title)
+            self.sizes.append(min(len(grams), 0xFFFF))
+            for gram in grams:
+                self.postings[gram].append(position)
+
+    def search(self, query, limit=50):
+        # [(score, conversation_id)], best first
+        query = " ".join(query.casefold().split())
+        grams = trigrams(query)
+        if not grams:
+            return []
+        shared = Counter()
+        for gram in grams:
+            postings = self.postings.get(gram)
+            if postings:
+                shared.update(postings)
+
+        # dice coefficient on trigrams picks a shortlist, the subsequence bonus
+        # only has to run over that
+        scored = ((2 * count / (len(grams) + self.sizes[position]), position) for position, count in shared.items())
+        shortlist = heapq.nlargest(limit * 4, scored)
+        ranked = [(score + subsequence_score(query, self.titles[position]), self.ids[position]) for score, position in shortlist]
+        return heapq.nlargest(limit, ranked)
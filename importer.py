@@ -0,0 +1,338 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timezone
+from PySide6.QtCore import QThread, Signal
+from crytpo import EncryptionWrapper, ContentHasher, new_messages_marker
+from db import Conversation, Message
+from messages import encrypt_messages
+from search import SearchIndex
+from collections import deque
+import json, os, sqlite3
+
+# Batch import of exported conversations, hand made markdown files or the
+# conversations.json of the official data export.
+# Conversations are encrypted and blinded for the search index in worker
+# processes, the rows then go into sqlite with executemany.
+# Nothing is read back, the tree is told about the new ids directly.
+# Bodies are stored a message at a time, see messages.py.
+# A conversation whose content hash is already in the database is skipped
+# before it's encrypted, and checked once more when inserting. Conversations
+# with an empty body (an export of images only, a file with just a title)
+# are never skipped, the body is all the hash knows about.
+
+def parse_markdown(content):
+    # (title, body), the first line is the title
+    lines = content.split("\n")
+    title = lines[0].lstrip('#').strip()
+    return title, '\n'.join(lines[1:])
+
+def find_markdown_files(directory):
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        paths.extend(os.path.join(root, name) for name in sorted(files) if name.lower().endswith(".md"))
+    return paths
+
+
+# conversations.json is one array of a few hundred megabytes. it's read a
+# chunk at a time and every element is decoded on its own as soon as it is
+# complete, so only one conversation is ever held as python objects.
+
+ROLE_HEADINGS = {"user": "User", "assistant": "ChatGPT", "tool": "Tool"}
+
+def iter_json_array(f, chunk_size=1024 * 1024):
+    # yields (element, characters consumed so far) for a file holding a json array
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    consumed = 0
+    started = False
+    eof = False
+
+    def skip(chars):
+        nonlocal position
+        while position < len(buffer) and buffer[position] in chars:
+            position += 1
+
+    while True:
+        skip(" \t\r\n")
+        if not started:
+            if position < len(buffer):
+                if buffer[position] != "[":
+                    raise ValueError("expected a json array")
+                position += 1
+                started = True
+                continue
+        elif position < len(buffer):
+            if buffer[position] == "]":
+                return
+            if buffer[position] == ",":
+                position += 1
+                skip(" \t\r\n")
+            if position < len(buffer):
+                try:
+                    element, end = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    # incomplete element, unless there's nothing more to read
+                    if eof:
+                        raise
+                else:
+                    # a number cut off by the chunk decodes fine, wait for what follows
+                    if end < len(buffer) or eof:
+                        consumed += end - position
+                        position = end
+                        yield element, consumed
+                        continue
+
+        if eof:
+            if started:
+                raise ValueError("unterminated json array")
+            return
+        # drop what's been decoded, then read on. a conversation bigger than
+        # the chunk makes the buffer grow until it fits
+        buffer = buffer[position:]
+        position = 0
+        chunk = f.read(max(chunk_size, len(buffer)))
+        if not chunk:
+            eof = True
+        buffer += chunk
+
+def linearize(conversation):
+    # the messages of a conversation form a tree (every regenerated answer
+    # is a branch), the one shown last is the path from current_node up
+    mapping = conversation.get("mapping") or {}
+    node_id = conversation.get("current_node")
+    path = []
+    while node_id != None and node_id in mapping:
+        node = mapping[node_id]
+        path.append(node)
+        node_id = node.get("parent")
+    path.reverse()
+
+    sections = []
+    for node in path:
+        message = node.get("message")
+        if not message:
+            continue
+        role = (message.get("author") or {}).get("role")
+        if role not in ROLE_HEADINGS:
+            continue
+        parts = (message.get("content") or {}).get("parts") or []
+        text = "\n\n".join(part for part in parts if isinstance(part, str)).strip()
+        if text:
+            sections.append(f"## {ROLE_HEADINGS[role]}\n\n{text}")
+    return "\n\n".join(sections)
+
+def export_time(timestamp):
+    # unix seconds in the export, sqlite's CURRENT_TIMESTAMP format in the db
+    if timestamp == None:
+        return None
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+_worker_password = None
+_worker_search_index = None
+_worker_hasher = None
+_worker_known_hashes = None
+
+def _init_worker(password, known_hashes):
+    global _worker_password, _worker_search_index, _worker_hasher, _worker_known_hashes
+    _worker_password = password
+    _worker_search_index = SearchIndex(password)
+    _worker_hasher = ContentHasher(password)
+    _worker_known_hashes = known_hashes
+
+def _encrypt(title, body, created_at, kdf):
+    # (title, data, salt, tokens, created_at, content_hash, messages), data is
+    # None when the database already has this conversation. conversations
+    # are stored per message, data is only the marker.
+    # content_hash is None for an empty body, ContentHashBackfill fills it in
+    content_hash = _worker_hasher.digest(body) if ContentHasher.normalize(body) else None
+    if content_hash != None and content_hash in _worker_known_hashes:
+        return title, None, None, None, created_at, content_hash, None
+    salt = EncryptionWrapper.generate_salt()
+    messages = encrypt_messages(body, EncryptionWrapper.get(_worker_password, salt, kdf), _worker_hasher)
+    return title, new_messages_marker(), salt, _worker_search_index.tokens(body), created_at, content_hash, messages
+
+def _encrypt_files(paths, kdf):
+    # [(path, encrypted)], encrypted is None for a file that can't be read
+    results = []
+    for path in paths:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                title, body = parse_markdown(f.read())
+        except (OSError, UnicodeDecodeError):
+            results.append((path, None))
+            continue
+        results.append((path, _encrypt(title, body, None, kdf)))
+    return results
+
+def _encrypt_conversations(conversations, kdf):
+    return [_encrypt(title, body, created_at, kdf) for title, body, created_at in conversations]
+
+def get_known_hashes(db_path):
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        return Conversation.get_content_hashes(conn.cursor())
+    finally:
+        conn.close()
+
+def insert_encrypted(conn, group_id, kdf, encrypted):
+    # encrypted is a list of what _encrypt returns, one transaction for all
+    # of them. returns (the new conversations without data, duplicates skipped)
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        # under the write lock, so this also sees what other batches, other
+        # imports or the same file picked twice added since the workers started
+        fresh = []
+        seen = set()
+        for entry in encrypted:
+            content_hash = entry[5]
+            if entry[1] == None:
+                continue
+            if content_hash != None:
+                if content_hash in seen or Conversation.has_content_hash(content_hash, cursor):
+                    continue
+                seen.add(content_hash)
+            fresh.append(entry)
+        conversations = [Conversation(None, title, group_id, data, None, salt, kdf) for title, data, salt, tokens, created_at, content_hash, messages in fresh]
+        ids = Conversation.add_many(conversations, cursor, [entry[4] for entry in fresh], [entry[5] for entry in fresh])
+        Message.save_many([Message(conversation_id, ordinal, role, data, message_hash)
+                           for conversation_id, entry in zip(ids, fresh) for ordinal, (role, data, message_hash) in enumerate(entry[6])], cursor)
+        SearchIndex.store([(conversation_id, entry[3]) for conversation_id, entry in zip(ids, fresh)], cursor)
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    for conversation_id, conversation in zip(ids, conversations):
+        conversation.id = conversation_id
+        conversation.data = None
+        conversation.tags = []
+    return conversations, len(encrypted) - len(fresh)
+
+
+class BatchImport(QThread):
+    # progress is (files encrypted, files)
+    progress = Signal(int, int)
+
+    def __init__(self, db_path, password, paths, group_id, kdf, chunk_size=20, parent=None):
+        super().__init__(parent)
+        self.db_path = db_path
+        self.password = password
+        self.paths = paths
+        self.group_id = group_id
+        self.kdf = kdf
+        self.chunk_size = chunk_size
+        # filled in by run, read once finished has fired
+        self.imported = []
+        self.failed = []
+        self.duplicates = 0
+        self.error = None
+
+    def run(self):
+        encrypted = []
+        workers = os.cpu_count() or 2
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self.password, get_known_hashes(self.db_path)))
+        try:
+            chunks = [self.paths[i:i + self.chunk_size] for i in range(0, len(self.paths), self.chunk_size)]
+            pending = set(pool.submit(_encrypt_files, chunk, self.kdf) for chunk in chunks)
+            while pending:
+                if self.isInterruptionRequested():
+                    return
+                done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                for future in done:
+                    encrypted.extend(future.result())
+                if done:
+                    self.progress.emit(len(encrypted), len(self.paths))
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+        # keep the order the files were picked in
+        order = {path: i for i, path in enumerate(self.paths)}
+        encrypted.sort(key=lambda result: order[result[0]])
+        self.failed = [path for path, entry in encrypted if entry == None]
+        encrypted = [entry for path, entry in encrypted if entry != None]
+        if not encrypted:
+            return
+
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            self.imported, self.duplicates = insert_encrypted(conn, self.group_id, self.kdf, encrypted)
+        except sqlite3.Error as e:
+            self.error = str(e)
+        finally:
+            conn.close()
+
+    def stop(self):
+        # the database part is a single transaction, only the encrypting can be cut short
+        self.requestInterruption()
+        self.wait()
+
+
+class ExportImport(QThread):
+    # conversations.json of the official export. parsing, encrypting and
+    # inserting overlap, at most a few batches are in flight at any time and
+    # every batch is committed as soon as it's encrypted, so memory stays
+    # flat however big the export is. batches are inserted in the order of the
+    # file even when a later one is encrypted first.
+    # progress is (conversations imported, percent of the file read)
+    progress = Signal(int, int)
+
+    def __init__(self, db_path, password, path, group_id, kdf, batch_size=50, parent=None):
+        super().__init__(parent)
+        self.db_path = db_path
+        self.password = password
+        self.path = path
+        self.size = os.path.getsize(path)
+        self.group_id = group_id
+        self.kdf = kdf
+        self.batch_size = batch_size
+        self.imported = []
+        self.failed = []
+        self.duplicates = 0
+        self.error = None
+
+    def run(self):
+        workers = os.cpu_count() or 2
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self.password, get_known_hashes(self.db_path)))
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                elements = iter_json_array(f)
+                pending = deque()
+                exhausted = False
+                read = 0
+                while not self.isInterruptionRequested():
+                    while not exhausted and len(pending) < workers * 2:
+                        batch = []
+                        for element, read in elements:
+                            body = linearize(element)
+                            title = element.get("title") or "Untitled"
+                            batch.append((title, body, export_time(element.get("create_time"))))
+                            if len(batch) >= self.batch_size:
+                                break
+                        else:
+                            exhausted = True
+                        if batch:
+                            pending.append(pool.submit(_encrypt_conversations, batch, self.kdf))
+                    if not pending:
+                        break
+
+                    done, not_done = wait([pending[0]], timeout=0.2)
+                    if done:
+                        future = pending.popleft()
+                        imported, duplicates = insert_encrypted(conn, self.group_id, self.kdf, future.result())
+                        self.imported.extend(imported)
+                        self.duplicates += duplicates
+                        # characters against bytes, close enough for a progress bar
+                        self.progress.emit(len(self.imported), min(100, read * 100 // max(self.size, 1)))
+        except (OSError, ValueError, sqlite3.Error) as e:
+            # ValueError covers broken json, what's committed so far stays
+            self.error = str(e)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+            conn.close()
+
+    def stop(self):
+        self.requestInterruption()
+        self.wait()
@@ -1,119 +1,371 @@
 from typing import Union
+from array import array
+from collections import deque
+import bisect
 from appdirs import user_data_dir
-from markdown_it import MarkdownIt
-import pygments
-from pygments.formatters import HtmlFormatter
 import configparser
 import os.path, glob
-import sys, ctypes
-from crytpo import EncryptionWrapper, SecureString
-from db import Database, Conversation, Tag, Group, Metadata
-from PySide6.QtCore import Qt, QSortFilterProxyModel,QModelIndex, QPersistentModelIndex
-from PySide6.QtGui import QStandardItem, QStandardItemModel, QAction, QColor, QFont,QMouseEvent, QShortcut, QTextCursor, QTextDocument, QPalette
-from PySide6.QtWidgets import QApplication, QSplitter, QTreeView, QTextEdit, QMainWindow, QToolBar, QWidget, QVBoxLayout, QFileDialog, QDialog, QDialogButtonBox, QTabWidget, QPushButton, QHBoxLayout, QListWidget, QListWidgetItem, QLineEdit, QMessageBox, QToolButton, QSizePolicy, QInputDialog, QStyledItemDelegate,QStyle
+import sys, ctypes, multiprocessing
+from crytpo import EncryptionWrapper, SecureString, ContentHasher, KDF_HKDF, new_messages_marker, is_messages_marker
+from messages import read_text, store_messages
+from revisions import record_revision, load_revision
+from maintenance import MaintenanceThread, KdfMigration, PayloadConversion
+from renderer import RenderCache, split_blocks
+from worker import ConversationLoader
+from search import SearchIndex, BruteForceSearch
+from fuzzy import TitleIndex
+from finder import TextFinder
+from importer import BatchImport, ExportImport, find_markdown_files
+from maintenance import SearchIndexBackfill, ContentHashBackfill, MessageSplit
+from db import Database, Conversation, ConversationHeader, Tag, Group, Metadata, Revision
+from bitmap import TagBitmaps, TagQuery, MATCH_ALL, MATCH_ANY
+from PySide6.QtCore import Qt, QPoint, QSortFilterProxyModel, QAbstractItemModel, QModelIndex, QPersistentModelIndex, QTimer, Signal
+from PySide6.QtGui import QAction, QColor, QFont,QMouseEvent, QShortcut, QTextCursor, QPalette
+from PySide6.QtWidgets import QApplication, QSplitter, QTreeView, QTextEdit, QMainWindow, QToolBar, QWidget, QVBoxLayout, QFileDialog, QDialog, QDialogButtonBox, QTabWidget, QPushButton, QHBoxLayout, QListWidget, QListWidgetItem, QLineEdit, QMessageBox, QToolButton, QSizePolicy, QInputDialog, QStyledItemDelegate,QStyle, QComboBox
 from group import GroupSelectionDialog, AddGroupDialog, ChangeGroupDialog
 from tag import ManageTagsDialog, AddTagsDialog
 
 
-class TreeModel(QStandardItemModel):
-    def __init__(self, header_labels, data, parent=None):
+class GroupNode:
+    # a group and the part of its conversations fetched so far, kept as flat
+    # arrays sorted by id instead of one qt item per conversation
+    def __init__(self, id, name, total):
+        self.id = id
+        self.name = name
+        self.total = total
+        self.ids = array('q')
+        self.titles = []
+        # casefolded titles, so filtering never lowercases on a keystroke
+        self.folded = []
+
+    def loaded(self):
+        return len(self.ids)
+
+    def last_id(self):
+        return self.ids[-1] if self.ids else 0
+
+
+class TreeModel(QAbstractItemModel):
+    # groups are loaded up front with their sizes, conversations are paged in
+    # from sqlite as the view asks for them (canFetchMore/fetchMore).
+    # index internal id: 0 for a group row, group row + 1 for a conversation row.
+    # lookups by id go through group_rows and conversation_groups, the row of a
+    # conversation inside its group is a bisect on the sorted ids.
+    page_size = 500
+
+    def __init__(self, header_labels, parent=None):
         super().__init__(parent)
-        self.setHorizontalHeaderLabels(header_labels)
-        self.update_data(data)
+        self.header_labels = header_labels
+        self.groups = []
+        self.group_rows = {}
+        # group id of every fetched conversation
+        self.conversation_groups = {}
+        # conversation ids of every tag, for every conversation fetched or not
+        self.tag_bitmaps = TagBitmaps()
+        # bumped whenever an already fetched title changes or a row shows up
+        # outside of paging, filters computed at an older revision are stale
+        self.revision = 0
+        self.title_index_cache = None
+        self.title_index_revision = None
+        self.update_data()
+
+    def update_data(self):
+        database = Database.get_instance()
+        cursor = database.get_cursor()
+        self.beginResetModel()
+        self.groups = [GroupNode(group.id, group.name, group.count) for group in Group.get_all_with_counts(cursor)]
+        self.group_rows = {group.id: row for row, group in enumerate(self.groups)}
+        self.conversation_groups = {}
+        self.tag_bitmaps = TagBitmaps.load(cursor)
+        self.revision += 1
+        self.endResetModel()
+
+    def index(self, row, column, parent=QModelIndex()):
+        if not self.hasIndex(row, column, parent):
+            return QModelIndex()
+        if not parent.isValid():
+            return self.createIndex(row, column, 0)
+        return self.createIndex(row, column, parent.row() + 1)
+
+    def parent(self, index):
+        if not index.isValid() or index.internalId() == 0:
+            return QModelIndex()
+        return self.createIndex(index.internalId() - 1, 0, 0)
+
+    def rowCount(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return len(self.groups)
+        if parent.internalId() == 0:
+            return self.groups[parent.row()].loaded()
+        return 0
+
+    def columnCount(self, parent=QModelIndex()):
+        return 1
+
+    def hasChildren(self, parent=QModelIndex()):
+        if not parent.isValid():
+            return len(self.groups) > 0
+        if parent.internalId() == 0:
+            # show the expander before anything has been fetched
+            return self.groups[parent.row()].total > 0
+        return False
+
+    def canFetchMore(self, parent):
+        if not parent.isValid() or parent.internalId() != 0:
+            return False
+        group = self.groups[parent.row()]
+        return group.loaded() < group.total
 
-    def update_data(self, data):
-        parent_item = self.invisibleRootItem()
-        # remove everything
+    def fetchMore(self, parent):
+        if not self.canFetchMore(parent):
+            return
+        group = self.groups[parent.row()]
         database = Database.get_instance()
         cursor = database.get_cursor()
-        tags_by_c = Tag.get_all_tags_grouped_by_conversation(cursor)
-
-        parent_item.removeRows(0, parent_item.rowCount())
-        for group_name, group_items in data.items():
-            # split group_name into id and name
-            split = group_name.split("-")
-            group_id = int(split[0])
-            group_name = "-".join(split[1:])
-            group_item = QStandardItem(group_name)
-            group_item.setData(group_id, Qt.UserRole)
-            parent_item.appendRow(group_item)
-            for item_name in group_items:
-                child_item = QStandardItem(item_name["title"])
-                child_item.setData(item_name["id"], Qt.UserRole)
-                child_item.setData("con", Qt.UserRole + 1)
-                if item_name["id"] in tags_by_c:
-                    child_item.setData(tags_by_c[item_name["id"]], Qt.UserRole + 2)
-                    
-                group_item.appendRow(child_item)
-    
+        page = Group.get_conversation_page(group.id, group.last_id(), self.page_size, cursor)
+        if not page:
+            # fewer rows than counted, something was deleted meanwhile
+            group.total = group.loaded()
+            return
+        self.append_rows(parent, group, page)
+
+    def fetch_all(self):
+        # filtering has to see every conversation, pull in whatever is left in one go
+        if all(group.loaded() >= group.total for group in self.groups):
+            return
+        database = Database.get_instance()
+        cursor = database.get_cursor()
+        for group, conversations in Group.get_tree(cursor):
+            row = self.group_rows.get(group.id)
+            if row == None:
+                continue
+            node = self.groups[row]
+            rest = [conversation for conversation in conversations if conversation[0] > node.last_id()]
+            node.total = node.loaded() + len(rest)
+            if rest:
+                self.append_rows(self.index(row, 0), node, rest)
+
+    def append_rows(self, parent, group, conversations):
+        first = group.loaded()
+        self.beginInsertRows(parent, first, first + len(conversations) - 1)
+        for conversation_id, title, tags in conversations:
+            group.ids.append(conversation_id)
+            group.titles.append(title)
+            group.folded.append(title.casefold())
+            self.conversation_groups[conversation_id] = group.id
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if index.internalId() == 0:
+            group = self.groups[index.row()]
+            if role == Qt.DisplayRole or role == Qt.EditRole:
+                return group.name
+            if role == Qt.UserRole:
+                return group.id
+            return None
+
+        group = self.groups[index.internalId() - 1]
+        conversation_id = group.ids[index.row()]
+        if role == Qt.DisplayRole or role == Qt.EditRole:
+            return group.titles[index.row()]
+        if role == Qt.UserRole:
+            return conversation_id
+        if role == Qt.UserRole + 1:
+            return "con"
+        if role == Qt.UserRole + 2:
+            return frozenset(self.tag_bitmaps.tags_of(conversation_id))
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid() or role != Qt.EditRole:
+            return False
+        if index.internalId() == 0:
+            self.groups[index.row()].name = value
+        else:
+            group = self.groups[index.internalId() - 1]
+            group.titles[index.row()] = value
+            group.folded[index.row()] = value.casefold()
+        self.revision += 1
+        self.dataChanged.emit(index, index, [Qt.DisplayRole, Qt.EditRole])
+        return True
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole and section < len(self.header_labels):
+            return self.header_labels[section]
+        return None
+
+    def find_group_row(self, group_id):
+        return self.group_rows.get(group_id)
+
+    def find_conversation(self, conversation_id, group_id=None):
+        # (group row, row), row is None when the conversation isn't fetched yet
+        if conversation_id in self.conversation_groups:
+            group_id = self.conversation_groups[conversation_id]
+        group_row = self.find_group_row(group_id)
+        if group_row == None:
+            return None, None
+        ids = self.groups[group_row].ids
+        row = bisect.bisect_left(ids, conversation_id)
+        if row < len(ids) and ids[row] == conversation_id:
+            return group_row, row
+        return group_row, None
+
     def tag_changed(self, conversation):
-        # loop through tree items for group with id == conversation.group_id
-        for i in range(self.rowCount()):
-            group_item = self.item(i)
-            if int(group_item.data(Qt.UserRole)) == conversation.group_id:
-                # loop through conversations
-                for j in range(group_item.rowCount()):
-                    conversation_item = group_item.child(j)
-                    if conversation_item.data(Qt.UserRole) == conversation.id:
-                        tag_ids = [tag.id for tag in conversation.tags]
-       
-                        conversation_item.setData(tag_ids, Qt.UserRole + 2)
-                        break
-                break
+        self.tag_bitmaps.set_tags(conversation.id, [tag.id for tag in conversation.tags])
+        self.revision += 1
+        group_row, row = self.find_conversation(conversation.id)
+        if row != None:
+            index = self.index(row, 0, self.index(group_row, 0))
+            self.dataChanged.emit(index, index, [Qt.UserRole + 2])
     
     def group_changed(self, old_group_id, new_group_id, conversation):
-        for i in range(self.rowCount()):
-            group_item = self.item(i)
-            if int(group_item.data(Qt.UserRole)) == old_group_id:
-                # loop through conversations
-                for j in range(group_item.rowCount()):
-                    conversation_item = group_item.child(j)
-                    if conversation_item.data(Qt.UserRole) == conversation.id:
-                        # remove the conversation from the group
-                        group_item.removeRow(j)
-                break
-        # loop through tree items for group with id == new_group_id
-        for i in range(self.rowCount()):
-            group_item = self.item(i)
-            if int(group_item.data(Qt.UserRole)) == new_group_id:
-                # add the conversation to the group
-                child_item = QStandardItem(conversation.title)
-                child_item.setData(conversation.id, Qt.UserRole)
-                child_item.setData("con", Qt.UserRole + 1)
-                child_item.setData(conversation.tags, Qt.UserRole + 2)
-                group_item.appendRow(child_item)
-                break
-        
+        group_row, row = self.find_conversation(conversation.id, old_group_id)
+        if group_row != None:
+            group = self.groups[group_row]
+            if row != None:
+                self.beginRemoveRows(self.index(group_row, 0), row, row)
+                del group.ids[row]
+                del group.titles[row]
+                del group.folded[row]
+                del self.conversation_groups[conversation.id]
+                self.endRemoveRows()
+            group.total -= 1
+        self.insert_conversation(new_group_id, conversation)
 
     def conversation_added(self, conversation):
         database = Database.get_instance()
         cursor = database.get_cursor()
-        tags = Tag.get_by_conversation_id(conversation.id, cursor)
-        # loop through tree items for group with id == conversation.group_id
-        for i in range(self.rowCount()):
-            group_item = self.item(i)
-            if int(group_item.data(Qt.UserRole)) == conversation.group_id:
-                # add the conversation to the group
-                child_item = QStandardItem(conversation.title)
-                child_item.setData(conversation.id, Qt.UserRole)
-                child_item.setData("con", Qt.UserRole + 1)
-                child_item.setData(tags, Qt.UserRole + 2)
-                group_item.appendRow(child_item)
-                break
+        conversation.tags = Tag.get_by_conversation_id(conversation.id, cursor)
+        self.insert_conversation(conversation.group_id, conversation)
+
+    def insert_conversation(self, group_id, conversation):
+        group_row = self.find_group_row(group_id)
+        if group_row == None:
+            return
+        group = self.groups[group_row]
+        group.total += 1
+        self.tag_bitmaps.set_tags(conversation.id, [tag.id for tag in conversation.tags])
+        self.revision += 1
+        # past the fetched part it arrives with a later page, in order
+        if group.loaded() < group.total - 1 and conversation.id > group.last_id():
+            return
+        row = bisect.bisect_left(group.ids, conversation.id)
+        self.beginInsertRows(self.index(group_row, 0), row, row)
+        group.ids.insert(row, conversation.id)
+        group.titles.insert(row, conversation.title)
+        group.folded.insert(row, conversation.title.casefold())
+        self.conversation_groups[conversation.id] = group.id
+        self.endInsertRows()
+
+    def remove_conversations(self, conversations):
+        # conversations is a list of (conversation_id, group_id).
+        # one layout change for the whole batch instead of a signal per row
+        removed_rows = {}
+        self.tag_bitmaps.remove_conversations([conversation_id for conversation_id, group_id in conversations])
+        for conversation_id, group_id in conversations:
+            group_row, row = self.find_conversation(conversation_id, group_id)
+            if group_row == None:
+                continue
+            self.groups[group_row].total -= 1
+            if row != None:
+                del self.conversation_groups[conversation_id]
+                removed_rows.setdefault(group_row, []).append(row)
+        # the tag bitmaps changed even when none of the rows was fetched
+        self.revision += 1
+        if not removed_rows:
+            return
+
+        self.layoutAboutToBeChanged.emit()
+        for group_row, rows in removed_rows.items():
+            rows.sort()
+            group = self.groups[group_row]
+            removed = set(rows)
+            group.ids = array('q', [id for row, id in enumerate(group.ids) if row not in removed])
+            group.titles = [title for row, title in enumerate(group.titles) if row not in removed]
+            group.folded = [title for row, title in enumerate(group.folded) if row not in removed]
+
+        old_indexes = self.persistentIndexList()
+        new_indexes = []
+        for index in old_indexes:
+            rows = removed_rows.get(index.internalId() - 1) if index.internalId() != 0 else None
+            if not rows:
+                new_indexes.append(index)
+                continue
+            shift = bisect.bisect_left(rows, index.row())
+            if shift < len(rows) and rows[shift] == index.row():
+                new_indexes.append(QModelIndex())
+            else:
+                new_indexes.append(self.createIndex(index.row() - shift, 0, index.internalId()))
+        self.changePersistentIndexList(old_indexes, new_indexes)
+        self.layoutChanged.emit()
+
+    def tags_removed(self, tag_ids):
+        if not tag_ids:
+            return
+        self.revision += 1
+        self.tag_bitmaps.remove_tags(tag_ids)
+
+    def title_index(self):
+        # trigram index over every title, rebuilt when the rows changed
+        self.fetch_all()
+        if self.title_index_cache == None or self.title_index_revision != self.revision:
+            self.title_index_cache = TitleIndex([(conversation_id, title) for group in self.groups for conversation_id, title in zip(group.ids, group.folded)])
+            self.title_index_revision = self.revision
+        return self.title_index_cache
+
+    def title(self, conversation_id):
+        group_row, row = self.find_conversation(conversation_id)
+        if row == None:
+            return None
+        return self.groups[group_row].titles[row]
+
+    def folded_title(self, conversation_id):
+        group_row, row = self.find_conversation(conversation_id)
+        if row == None:
+            return None
+        return self.groups[group_row].folded[row]
 
     def group_added(self, group):
         # add the group to the tree
-        group_item = QStandardItem(group.name)
-        group_item.setData(group.id, Qt.UserRole)
-        self.appendRow(group_item)
+        row = len(self.groups)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.groups.append(GroupNode(group.id, group.name, 0))
+        self.group_rows[group.id] = row
+        self.endInsertRows()
 
 class FilterProxyModel(QSortFilterProxyModel):
+    # typing only restarts a short timer. when it fires, the matching
+    # conversation ids are worked out once from the model's casefolded titles
+    # and the tag bitmaps, and filterAcceptsRow is a set lookup. a query that
+    # extends the previous one only re-checks the previous matches.
+    filter_applied = Signal()
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setFilterCaseSensitivity(Qt.CaseInsensitive)
         self.setFilterKeyColumn(0)
         self.filter = ""
-        self.tag_id = None
+        self.tag_query = TagQuery()
+
+        self.matches = None
+        self.matching_groups = None
+        self.matched_query = None
+        self.matched_tag_query = None
+        self.matched_revision = None
+        self.tag_match = None
+        self.tag_match_revision = None
+
+        self.filter_timer = QTimer(self)
+        self.filter_timer.setSingleShot(True)
+        self.filter_timer.setInterval(150)
+        self.filter_timer.timeout.connect(self.apply_filter)
 
     def data(self, index, role=Qt.DisplayRole):
         if role == Qt.DisplayRole:
@@ -127,62 +379,105 @@ class FilterProxyModel(QSortFilterProxyModel):
     
     def setFilter(self, filter: str) -> None:
         self.filter = filter
+        self.filter_timer.start()
+
+    def setTagQuery(self, tag_query):
+        self.tag_query = tag_query
+        self.filter_timer.stop()
+        self.apply_filter()
+
+    def apply_filter(self):
+        source_model = self.sourceModel()
+        query = self.filter.casefold()
+        tag_query = self.tag_query
+        if not query and tag_query.is_empty():
+            self.matches = None
+        else:
+            source_model.fetch_all()
+            if self.can_narrow(query):
+                candidates = [(conversation_id, source_model.folded_title(conversation_id)) for conversation_id in self.matches]
+                candidates = [(conversation_id, title) for conversation_id, title in candidates if title != None]
+            else:
+                groups = source_model.groups
+                if tag_query.group_ids:
+                    groups = [group for group in groups if group.id in tag_query.group_ids]
+                candidates = [(conversation_id, title) for group in groups for conversation_id, title in zip(group.ids, group.folded)]
+            tag_match = self.current_tag_match()
+            if tag_match == None:
+                self.matches = set(conversation_id for conversation_id, title in candidates if query in title)
+            else:
+                self.matches = set(conversation_id for conversation_id, title in candidates if query in title and conversation_id in tag_match)
+            self.matching_groups = set(source_model.conversation_groups[conversation_id] for conversation_id in self.matches)
+        self.matched_query = query
+        self.matched_tag_query = tag_query
+        self.matched_revision = source_model.revision
         self.invalidateFilter()
-        window.tree_view.expandAll()
+        self.filter_applied.emit()
+
+    def can_narrow(self, query):
+        return self.matches != None \
+            and self.matched_revision == self.sourceModel().revision \
+            and self.matched_tag_query == self.tag_query \
+            and query.startswith(self.matched_query)
+
+    def current_tag_match(self):
+        # the and/or/not over the tag bitmaps, redone only when the tags or
+        # the model changed. None when no tag is involved
+        tag_query = self.tag_query
+        if not tag_query.include and not tag_query.exclude:
+            return None
+        source_model = self.sourceModel()
+        if self.tag_match == None or self.tag_match_revision != (source_model.revision, tag_query):
+            self.tag_match = source_model.tag_bitmaps.match(tag_query)
+            self.tag_match_revision = (source_model.revision, tag_query)
+        return self.tag_match
+
+    def accepts_conversation(self, conversation_id, group_id, title):
+        tag_query = self.matched_tag_query
+        if tag_query.group_ids and group_id not in tag_query.group_ids:
+            return False
+        if self.matched_query not in title:
+            return False
+        tag_match = self.current_tag_match()
+        return tag_match == None or conversation_id in tag_match
     
     def filterAcceptsRow(self, source_row: int, source_parent: QModelIndex | QPersistentModelIndex) -> bool:
-        source_model = self.sourceModel()
-        source_index = source_model.index(source_row, 0, source_parent)
-        item_text = source_model.data(source_index, Qt.DisplayRole)
-
-        if self.tag_id != None:
-            if source_model.data(source_index, Qt.UserRole + 1) == "con":
-                tags = source_model.data(source_index, Qt.UserRole + 2)
-                if tags == None:
-                    return False
-                if self.tag_id not in tags:
-                    return False
-        
-        if not self.filter:
-            return True
-
-        if self.filter.lower() in item_text.lower():
+        if self.matches == None:
             return True
-
-        # Check nested rows (conversations)
-        if source_model.hasChildren(source_index):
-            for row in range(source_model.rowCount(source_index)):
-                if self.filterAcceptsRow(row, source_index):
-                    return True
-
-        return False
+        source_model = self.sourceModel()
+        stale = self.matched_revision != source_model.revision
+
+        if not source_parent.isValid():
+            group = source_model.groups[source_row]
+            group_ids = self.matched_tag_query.group_ids
+            if group_ids and group.id not in group_ids:
+                return False
+            # like before, a group stays visible when only the tag filter is set
+            if not self.matched_query:
+                return True
+            if self.matched_query in group.name.casefold():
+                return True
+            if stale:
+                return any(self.matched_query in title for title in group.folded)
+            return group.id in self.matching_groups
+
+        group = source_model.groups[source_parent.row()]
+        conversation_id = group.ids[source_row]
+        if stale:
+            # rows changed since the matches were worked out, check this one directly
+            return self.accepts_conversation(conversation_id, group.id, group.folded[source_row])
+        return conversation_id in self.matches
+
+def conversation_wrapper(conversation):
+    return EncryptionWrapper.get(str(secure_key), conversation.salt, conversation.kdf)
 
 def handle_item_clicked(index):
     tree_model = window.proxy_model
     item_type = tree_model.data(index, Qt.UserRole + 1)
     item_id = tree_model.data(index, Qt.UserRole)
     if item_type == "con":
-        conversation_id = item_id
-        database = Database.get_instance()
-        cursor = database.get_cursor()
-        conversation = Conversation.get_by_id(conversation_id, cursor)
-        tags = Tag.get_by_conversation_id(conversation_id, cursor)
-        conversation.tags = tags
-        encryption_wrapper = EncryptionWrapper(str(secure_key), conversation.salt)
-        decrypted_content = encryption_wrapper.decrypt(
-            conversation.data)
-
-        md = MarkdownIt()
-        formatter = HtmlFormatter(stylex="colorful")
-        md.renderer.rules['code'] = lambda tokens, idx, options, env, slf: \
-            '<div class="code-container">' \
-            '<pre class="highlight"><code>' + pygments.highlight(tokens[idx]['content'], md.lexer, formatter) + '</code></pre><button class="copy-button" onclick="copyCode(this)">Copy</button></div>'
-
-        window.update_active_conversation(conversation)
-        html = md.render(decrypted_content)
-        window.text_edit.setHtml(html)
-        window.text_edit.setReadOnly(True)
-        window.reset_edit()
+        # the result lands in MainWindow.conversation_loaded
+        window.loader.load(item_id)
         
 
 def create_toolbar(parent):
@@ -193,11 +488,19 @@ def create_toolbar(parent):
     import_action.setShortcut("Ctrl+I")
     import_action.triggered.connect(parent.import_history)
 
+    import_directory_action = QAction("Import Directory", parent)
+    import_directory_action.triggered.connect(parent.import_directory)
+
+    import_export_action = QAction("Import ChatGPT Export", parent)
+    import_export_action.triggered.connect(parent.import_export)
+
     delete_action = QAction("Batch Delete", parent)
     delete_action.setShortcut("Ctrl+D")
     delete_action.triggered.connect(show_delete_dialog)
 
     toolbar.addAction(import_action)
+    toolbar.addAction(import_directory_action)
+    toolbar.addAction(import_export_action)
     toolbar.addAction(delete_action)
 
     return toolbar
@@ -205,15 +508,14 @@ def create_toolbar(parent):
 def show_delete_dialog():
     dialog = BatchDeleteDialog()
     dialog.exec()
-    data = {}
-    database = Database.get_instance()
-    cursor = database.get_cursor()
-    groups = Group.get_all(cursor)
-    for group in groups:
-        conversations = Conversation.get_by_group_id(group.id, cursor)
-        data[f"{group.id}-{group.name}"] = [{"title": conversation.title, "id": conversation.id} for conversation in conversations]
-    window.tree_model.update_data(data)
+    if dialog.groups_deleted:
+        # conversations moved to the default group, start over
+        window.tree_model.update_data()
+    else:
+        window.tree_model.remove_conversations(dialog.deleted_conversations)
+        window.tree_model.tags_removed(dialog.deleted_tag_ids)
     window.refresh_tag_lists()
+    window.refresh_group_filter()
 
 def create_tree_view(parent):
     tree_view = QTreeView(parent)
@@ -231,6 +533,10 @@ class BatchDeleteDialog(QDialog):
     def __init__(self):
         super().__init__()
         self.current_tab = "group"
+        # what changed, for updating the tree afterwards
+        self.groups_deleted = False
+        self.deleted_conversations = []
+        self.deleted_tag_ids = []
 
         self.setWindowTitle("Batch Delete")
         self.setMinimumSize(300, 200)
@@ -318,10 +624,12 @@ class BatchDeleteDialog(QDialog):
 
         database = Database.get_instance()
         cursor = database.get_cursor()
-        conversations = Conversation.get_all(cursor)
+        # titles only, the encrypted bodies stay in the database
+        conversations = ConversationHeader.get_all(cursor)
         for conversation in conversations:
             item = QListWidgetItem(conversation.title)
             item.setData(Qt.UserRole, conversation.id)
+            item.setData(Qt.UserRole + 1, conversation.group_id)
             self.conversation_list.addItem(item)
         
         container_layout.addWidget(self.conversation_list)
@@ -380,6 +688,7 @@ class BatchDeleteDialog(QDialog):
                 cursor = database.get_cursor()
                 Group.delete(group_id, cursor)
                 database.conn.commit()
+                self.groups_deleted = True
                 self.group_list.takeItem(self.group_list.row(item))
         elif self.current_tab == "conversation":
             for item in self.conversation_list.selectedItems():
@@ -393,6 +702,7 @@ class BatchDeleteDialog(QDialog):
 
                 Conversation.delete(conversation_id, cursor)
                 database.conn.commit()
+                self.deleted_conversations.append((conversation_id, item.data(Qt.UserRole + 1)))
                 self.conversation_list.takeItem(self.conversation_list.row(item))
         elif self.current_tab == "tag":
             for item in self.tag_list.selectedItems():
@@ -400,18 +710,16 @@ class BatchDeleteDialog(QDialog):
                 database = Database.get_instance()
                 cursor = database.get_cursor()
 
-                conversations = Conversation.get_by_tag_id(tag_id, cursor)
-                for conversation in conversations:
-                    Conversation.remove_tag(conversation.id, tag_id, cursor)
-
                 Tag.delete(tag_id, cursor)
                 database.conn.commit()
+                self.deleted_tag_ids.append(tag_id)
                 self.tag_list.takeItem(self.tag_list.row(item))
 
 class MainWindow(QMainWindow):
-    def __init__(self, header_labels, data):
+    def __init__(self, header_labels):
         super().__init__()
         self.active_conversation = None
+        self.edit_base_text = ""
 
         # Create the widgets
         self.tree_view = create_tree_view(self)
@@ -431,6 +739,14 @@ class MainWindow(QMainWindow):
         self.find_input.setMinimumWidth(200)
         self.find_input.setMaximumWidth(200)
         self.find_input.textChanged.connect(self.find_text)
+        # matches come from the document's text, folded once and kept until
+        # the document changes
+        self.finder = TextFinder()
+        self.finder_stale = True
+        self.find_timer = QTimer(self)
+        self.find_timer.setSingleShot(True)
+        self.find_timer.setInterval(100)
+        self.find_timer.timeout.connect(self.run_find)
         self.find_input.returnPressed.connect(self.find_next)
 
 
@@ -441,9 +757,22 @@ class MainWindow(QMainWindow):
         self.find_input.setClearButtonEnabled(True)
         self.find_input.setFocus()
         
+        # search across every conversation, find is within the open one
+        self.search_input = QLineEdit()
+        self.search_input.setPlaceholderText("Search all")
+        self.search_input.setStyleSheet("background-color: white; border: 1px solid black; border-radius: 5px;")
+        self.search_input.setMinimumWidth(200)
+        self.search_input.setMaximumWidth(200)
+        self.search_input.setClearButtonEnabled(True)
+        self.search_input.returnPressed.connect(self.search_all)
+        self.search_input.textChanged.connect(self.search_cleared)
+        self.brute_force_search = None
+        self.batch_import = None
+
         spacer = QWidget()
         spacer.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
         self.toolbar.addWidget(spacer)
+        self.toolbar.addWidget(self.search_input)
         self.toolbar.addWidget(self.find_input)
 
         self.find_shortcut = QShortcut("Ctrl+F", self)
@@ -468,23 +797,46 @@ class MainWindow(QMainWindow):
         self.filter_shortcut = QShortcut("Esc", self)
         self.filter_shortcut.activated.connect(self.find_input.clearFocus)
         self.filter_shortcut.activated.connect(filter_input.clearFocus)
-
-        self.leftcolumn.addWidget(filter_input)
+        self.filter_shortcut.activated.connect(self.stop_search)
+
+        # fuzzy mode ranks titles into the result list instead of filtering the tree
+        self.fuzzy_button = QToolButton()
+        self.fuzzy_button.setText("Fuzzy")
+        self.fuzzy_button.setCheckable(True)
+        self.fuzzy_timer = QTimer(self)
+        self.fuzzy_timer.setSingleShot(True)
+        self.fuzzy_timer.setInterval(150)
+        self.fuzzy_timer.timeout.connect(self.fuzzy_search)
+
+        filter_row = QHBoxLayout()
+        filter_row.addWidget(filter_input)
+        filter_row.addWidget(self.fuzzy_button)
+        self.leftcolumn.addLayout(filter_row)
+        self.filter_input = filter_input
+
+        ## tag and group filter
+        # a checked tag is required, a partially checked one is excluded
+        tag_filter_row = QHBoxLayout()
+        self.tag_mode = QComboBox()
+        self.tag_mode.addItem("All tags", MATCH_ALL)
+        self.tag_mode.addItem("Any tag", MATCH_ANY)
+        self.group_filter = QComboBox()
+        tag_filter_row.addWidget(self.tag_mode)
+        tag_filter_row.addWidget(self.group_filter)
+        self.leftcolumn.addLayout(tag_filter_row)
 
         ## list of tags
         self.tag_list = QListWidget()
-        self.tag_list.setSelectionMode(QListWidget.SingleSelection)
+        self.tag_list.setSelectionMode(QListWidget.NoSelection)
         self.tag_list.setMaximumHeight(100)
         self.leftcolumn.addWidget(self.tag_list)
-        self.tag_list.itemSelectionChanged.connect(self.tag_selected)
-        self.refresh_tag_lists()
 
         toolbar = QToolBar()
         toolbar.setMinimumHeight(30)
         add_group_action = QAction("Add Group", self)
         add_group_action.triggered.connect(self.add_group)
         
-        clear_tag_selection_action = QAction("Clear Tag", self)
+        clear_tag_selection_action = QAction("Clear Tags", self)
         clear_tag_selection_action.triggered.connect(self.clear_tag_selection)
 
         refresh_action = QAction("Refresh", self)
@@ -504,6 +856,12 @@ class MainWindow(QMainWindow):
         self.leftcolumn.addWidget(toolbar)
         
         self.leftcolumn.addWidget(self.tree_view)
+
+        self.results_list = QListWidget()
+        self.results_list.setSelectionMode(QListWidget.SingleSelection)
+        self.results_list.currentItemChanged.connect(self.result_selected)
+        self.results_list.hide()
+        self.leftcolumn.addWidget(self.results_list)
         # Create a splitter to handle resizing
         self.rightcolumn.addWidget(self.text_edit)
         
@@ -517,7 +875,7 @@ class MainWindow(QMainWindow):
         splitter.setChildrenCollapsible(False)
 
         # Set up the tree model
-        self.tree_model = TreeModel(header_labels, data)
+        self.tree_model = TreeModel(header_labels)
         self.proxy_model = FilterProxyModel()
         self.proxy_model.setSourceModel(self.tree_model)
 
@@ -526,10 +884,33 @@ class MainWindow(QMainWindow):
         
         # handle when items displayed is editted
         self.tree_view.entered.connect(self.tree_view_editted)
-        self.tree_view.clicked.connect(handle_item_clicked)
+        # follows arrow key navigation as well as clicks
+        self.tree_view.selectionModel().currentChanged.connect(lambda current, previous: handle_item_clicked(current))
         self.tree_model.dataChanged.connect(self.tree_view_editted)
 
-        filter_input.textChanged.connect(self.proxy_model.setFilter)
+        self.loader = ConversationLoader(str(secure_key), render_cache, Database.get_instance(), self)
+        self.loader.loaded.connect(self.conversation_loaded)
+
+        # long conversations are laid out a block at a time, see show_html
+        self.pending_blocks = deque()
+        self.block_timer = QTimer(self)
+        self.block_timer.setSingleShot(True)
+        self.block_timer.setInterval(15)
+        self.block_timer.timeout.connect(self.append_idle_block)
+        self.text_edit.verticalScrollBar().valueChanged.connect(self.text_scrolled)
+        self.text_edit.document().contentsChanged.connect(self.document_changed)
+        self.loader.preview.connect(self.conversation_preview)
+        self.loader.failed.connect(self.conversation_failed)
+
+        filter_input.textChanged.connect(self.filter_changed)
+        self.fuzzy_button.toggled.connect(self.fuzzy_toggled)
+        self.proxy_model.filter_applied.connect(self.filter_applied)
+
+        self.refresh_tag_lists()
+        self.refresh_group_filter()
+        self.tag_list.itemChanged.connect(self.tag_state_changed)
+        self.tag_mode.currentIndexChanged.connect(self.tag_selected)
+        self.group_filter.currentIndexChanged.connect(self.tag_selected)
 
         # Set up the layout for the toolbar and splitter
         layout = QVBoxLayout()
@@ -549,35 +930,75 @@ class MainWindow(QMainWindow):
 
     def find_previous(self):
         # find the previous occurence of the text
-        text = self.find_input.text()
-        if text == "":
+        if not self.find_ready():
             return
-        self.text_edit.find(text, QTextDocument.FindBackward)
+        match = self.finder.previous(self.text_edit.textCursor().selectionStart())
+        if match != None:
+            self.select_match(match)
     
     def find_text(self):
-        # find the text, move the cursor to the next occurence
-        # highlight the text in blue rect
+        # typing restarts the timer, the search runs once it pauses
+        self.find_timer.start()
+
+    def find_ready(self):
+        # run a find still waiting on the timer, False when there's nothing to find
+        if self.find_input.text() == "":
+            return False
+        if self.find_timer.isActive() or self.finder_stale or self.finder.query == "":
+            self.run_find()
+        return True
+
+    def run_find(self):
+        self.find_timer.stop()
         text = self.find_input.text()
-        cursor = self.text_edit.textCursor()
-        cursor.movePosition(QTextCursor.Start)
+        if text == "":
+            self.text_edit.setExtraSelections([])
+            return
+        if self.finder_stale:
+            self.finish_blocks()
+            self.finder.set_text(self.text_edit.document().toPlainText())
+            self.finder_stale = False
+        self.finder.find(text)
+        self.highlight_visible()
+
+    def document_changed(self):
+        self.finder_stale = True
+
+    def highlight_visible(self):
+        # only the matches on screen and a screenful either side get a
+        # selection, scrolling brings in the next ones
+        if self.finder_stale or self.find_input.text() == "":
+            return
+        viewport = self.text_edit.viewport()
+        top = self.text_edit.cursorForPosition(QPoint(0, 0)).position()
+        bottom = self.text_edit.cursorForPosition(QPoint(viewport.width() - 1, viewport.height() - 1)).position()
+        margin = max(bottom - top, 1000)
+        document = self.text_edit.document()
         selections = []
-        while cursor.position() < self.text_edit.document().characterCount():
-            cursor = self.text_edit.document().find(text, cursor)
-            if cursor.isNull():
-                break
+        for start, end in self.finder.between(top - margin, bottom + margin):
             selection = QTextEdit.ExtraSelection()
             selection.format.setBackground(QColor("yellow"))
-            selection.cursor = cursor
+            selection.cursor = QTextCursor(document)
+            selection.cursor.setPosition(start)
+            selection.cursor.setPosition(end, QTextCursor.KeepAnchor)
             selections.append(selection)
         self.text_edit.setExtraSelections(selections)
 
+    def select_match(self, match):
+        cursor = self.text_edit.textCursor()
+        cursor.setPosition(match[0])
+        cursor.setPosition(match[1], QTextCursor.KeepAnchor)
+        self.text_edit.setTextCursor(cursor)
+        self.text_edit.ensureCursorVisible()
+        self.highlight_visible()
 
     def find_next(self):
         # find the next occurence of the text
-        text = self.find_input.text()
-        if text == "":
+        if not self.find_ready():
             return
-        self.text_edit.find(text)
+        match = self.finder.next(self.text_edit.textCursor().selectionEnd())
+        if match != None:
+            self.select_match(match)
        
 
     def tree_view_editted(self):
@@ -598,25 +1019,218 @@ class MainWindow(QMainWindow):
                 group = Group(item_id, title)
                 Group.update(group, cursor)
                 database.conn.commit()
+                self.refresh_group_filter()
 
         
     def refresh_data(self):
-        database = Database.get_instance()
-        cursor = database.get_cursor()
-        data = {}
-        groups = Group.get_all(cursor)
-        for group in groups:
-            conversations = Conversation.get_by_group_id(group.id, cursor)
-            data[f"{group.id}-{group.name}"] = [{"title": conversation.title, "id": conversation.id} for conversation in conversations]
-        self.tree_model.update_data(data)
+        self.tree_model.update_data()
+        self.refresh_group_filter()
 
     def update_active_conversation(self, conversation):
         self.active_conversation = conversation
 
+    def search_all(self):
+        query = self.search_input.text()
+        self.stop_search()
+        self.results_list.clear()
+        if query.strip() == "":
+            self.results_list.hide()
+            return
+        self.results_list.show()
+        database = Database.get_instance()
+        cursor = database.get_cursor()
+        if SearchIndex.is_complete(cursor):
+            self.add_search_results(search_index.search(query, cursor))
+            self.statusBar().showMessage(f"{self.results_list.count()} conversations match")
+            return
+
+        # no complete index yet, decrypt everything in worker processes instead
+        self.brute_force_search = BruteForceSearch(db_path, str(secure_key), query, parent=self)
+        self.brute_force_search.hits.connect(self.add_search_results)
+        self.brute_force_search.progress.connect(self.search_progress)
+        self.brute_force_search.finished.connect(self.search_finished)
+        self.statusBar().showMessage("Searching, index still being built...")
+        self.brute_force_search.start()
+
+    def add_search_results(self, results):
+        for conversation_id, title, group_id in results:
+            item = QListWidgetItem(title)
+            item.setData(Qt.UserRole, conversation_id)
+            self.results_list.addItem(item)
+
+    def search_progress(self, scanned, rate):
+        if self.sender() is not self.brute_force_search:
+            return
+        self.statusBar().showMessage(f"{self.results_list.count()} matches, {scanned} conversations searched ({rate:.0f}/s)")
+
+    def search_finished(self):
+        # a search that was stopped or replaced has nothing to report
+        if self.sender() is not self.brute_force_search:
+            return
+        self.brute_force_search = None
+        self.statusBar().showMessage(f"{self.results_list.count()} conversations match")
+
+    def stop_search(self):
+        if self.brute_force_search != None:
+            search = self.brute_force_search
+            self.brute_force_search = None
+            search.hits.disconnect(self.add_search_results)
+            search.stop()
+
+    def search_cleared(self, text):
+        if text == "":
+            self.stop_search()
+            self.results_list.clear()
+            self.results_list.hide()
+            self.statusBar().clearMessage()
+
+    def filter_changed(self, text):
+        if self.fuzzy_button.isChecked():
+            self.fuzzy_timer.start()
+        else:
+            self.proxy_model.setFilter(text)
+
+    def fuzzy_toggled(self, checked):
+        text = self.filter_input.text()
+        if checked:
+            self.proxy_model.setFilter("")
+            self.fuzzy_search()
+        else:
+            self.fuzzy_timer.stop()
+            self.results_list.clear()
+            self.results_list.hide()
+            self.proxy_model.setFilter(text)
+
+    def fuzzy_search(self, limit=50):
+        self.stop_search()
+        self.results_list.clear()
+        query = self.filter_input.text()
+        if query.strip() == "":
+            self.results_list.hide()
+            return
+        self.results_list.show()
+        for score, conversation_id in self.tree_model.title_index().search(query, limit):
+            group_row, row = self.tree_model.find_conversation(conversation_id)
+            if group_row == None or row == None:
+                continue
+            item = QListWidgetItem(f"{self.tree_model.title(conversation_id)}  ({self.tree_model.groups[group_row].name})")
+            item.setData(Qt.UserRole, conversation_id)
+            self.results_list.addItem(item)
+        self.statusBar().showMessage(f"{self.results_list.count()} best matches")
+
+    def result_selected(self, current, previous):
+        if current != None:
+            self.loader.load(current.data(Qt.UserRole))
+
+    def conversation_loaded(self, generation, conversation, html):
+        # a newer click or an edit superseded this one
+        if not self.loader.is_current(generation):
+            return
+        self.update_active_conversation(conversation)
+        self.toggle_edit_button.setChecked(False)
+        self.toggle_edit_button.setDisabled(False)
+        self.save_button.setDisabled(True)
+        self.show_html(html)
+        self.text_edit.setReadOnly(True)
+        self.prefetch_neighbours()
+
+    def conversation_preview(self, generation, html):
+        # the beginning of a big conversation while the rest is decrypted.
+        # nothing to edit until all of it is there
+        if not self.loader.is_current(generation):
+            return
+        self.update_active_conversation(None)
+        self.toggle_edit_button.setChecked(False)
+        self.toggle_edit_button.setDisabled(True)
+        self.save_button.setDisabled(True)
+        self.show_html(html)
+        self.text_edit.setReadOnly(True)
+
+    def show_html(self, html):
+        # only the first block goes through setHtml, the others are appended
+        # while the event loop is idle, or right away when scrolled towards them
+        blocks = split_blocks(html)
+        self.clear_blocks()
+        self.text_edit.setHtml(blocks[0])
+        self.pending_blocks.extend(blocks[1:])
+        if self.pending_blocks:
+            self.block_timer.start()
+
+    def append_blocks(self, count):
+        cursor = QTextCursor(self.text_edit.document())
+        while self.pending_blocks and count > 0:
+            cursor.movePosition(QTextCursor.End)
+            # html inserted into a paragraph merges its first block into it,
+            # and into an empty one it loses its heading, list or pre format.
+            # a throwaway paragraph takes that place and is removed again,
+            # which leaves the same blocks as a single setHtml
+            start = cursor.position()
+            cursor.insertHtml("<p>#</p>" + self.pending_blocks.popleft())
+            placeholder = QTextCursor(self.text_edit.document())
+            placeholder.setPosition(start)
+            placeholder.setPosition(start + 1, QTextCursor.KeepAnchor)
+            placeholder.removeSelectedText()
+            count -= 1
+
+    def append_idle_block(self):
+        self.append_blocks(1)
+        if self.pending_blocks:
+            self.block_timer.start()
+
+    def text_scrolled(self, value):
+        scroll_bar = self.text_edit.verticalScrollBar()
+        if self.pending_blocks and value >= scroll_bar.maximum() - scroll_bar.pageStep():
+            self.append_blocks(2)
+        self.highlight_visible()
+
+    def finish_blocks(self):
+        # everything has to be there before searching the document
+        self.block_timer.stop()
+        self.append_blocks(len(self.pending_blocks))
+
+    def clear_blocks(self):
+        self.block_timer.stop()
+        self.pending_blocks.clear()
+        # the matches belong to the text that's being replaced
+        self.text_edit.setExtraSelections([])
+
+    def prefetch_neighbours(self, count=3):
+        # siblings as the user sees them, so filtering is respected.
+        # walking down a group is the common case, the next ones go first
+        index = self.tree_view.currentIndex()
+        if not index.isValid() or self.proxy_model.data(index, Qt.UserRole + 1) != "con":
+            return
+        parent = index.parent()
+        row_count = self.proxy_model.rowCount(parent)
+        conversation_ids = []
+        for offset in range(1, count + 1):
+            for row in (index.row() + offset, index.row() - offset):
+                if 0 <= row < row_count:
+                    sibling = self.proxy_model.index(row, 0, parent)
+                    conversation_ids.append(self.proxy_model.data(sibling, Qt.UserRole))
+        self.loader.prefetch(conversation_ids)
+
+    def conversation_failed(self, generation, message):
+        if not self.loader.is_current(generation):
+            return
+        self.clear_blocks()
+        self.text_edit.setPlainText("Could not open conversation: " + message)
+        self.text_edit.setReadOnly(True)
+        self.toggle_edit_button.setDisabled(False)
+
+    def filter_applied(self):
+        if self.proxy_model.matches != None:
+            self.tree_view.expandAll()
+
     def clear_tag_selection(self):
-        self.tag_list.clearSelection()
-        self.proxy_model.tag_id = None
-        self.proxy_model.invalidateFilter()
+        self.tag_list.blockSignals(True)
+        for i in range(self.tag_list.count()):
+            self.set_tag_state(self.tag_list.item(i), Qt.Unchecked)
+        self.tag_list.blockSignals(False)
+        self.group_filter.blockSignals(True)
+        self.group_filter.setCurrentIndex(0)
+        self.group_filter.blockSignals(False)
+        self.tag_selected()
 
     def create_toolbar_under_text_edit(self):
         self.toolbar_textedit = QToolBar(self)
@@ -638,6 +1252,11 @@ class MainWindow(QMainWindow):
         button_change_group.clicked.connect(self.change_group)
         self.toolbar_textedit.addWidget(button_change_group)
 
+        button_history = QToolButton()
+        button_history.setText("History")
+        button_history.clicked.connect(self.show_history)
+        self.toolbar_textedit.addWidget(button_history)
+
         spacer_widget = QWidget()
         spacer_widget.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
         self.toolbar_textedit.addWidget(spacer_widget)
@@ -661,10 +1280,18 @@ class MainWindow(QMainWindow):
             return
         database = Database.get_instance()
         cursor = database.get_cursor()
-        encryption_wrapper = EncryptionWrapper(str(secure_key), self.active_conversation.salt)
-        encrypted_content = encryption_wrapper.encrypt(self.text_edit.toPlainText())
-        self.active_conversation.data = encrypted_content
-        Conversation.update_data(self.active_conversation.id, encrypted_content, cursor)
+        # saving moves the row onto the current key scheme and into messages,
+        # only the messages that changed are encrypted again
+        rewrite = self.active_conversation.kdf != kdf_version or not is_messages_marker(self.active_conversation.data)
+        self.active_conversation.kdf = kdf_version
+        encryption_wrapper = conversation_wrapper(self.active_conversation)
+        plaintext = self.text_edit.toPlainText()
+        record_revision(self.active_conversation.id, self.edit_base_text, plaintext, encryption_wrapper, kdf_version, content_hasher, cursor)
+        store_messages(self.active_conversation.id, plaintext, encryption_wrapper, content_hasher, cursor, rewrite)
+        marker = new_messages_marker()
+        self.active_conversation.data = marker
+        Conversation.update_data(self.active_conversation.id, marker, kdf_version, cursor, content_hasher.digest(plaintext))
+        search_index.index(self.active_conversation.id, plaintext, cursor)
         database.conn.commit()
         self.save_button.setDisabled(True)
         self.reset_edit()
@@ -677,28 +1304,47 @@ class MainWindow(QMainWindow):
         if self.active_conversation == None:
             return
         if self.toggle_edit_button.isChecked():
+            # a rendering still on its way must not replace the editor
+            self.loader.cancel()
             self.save_button.setDisabled(False)
-            encryption_wrapper = EncryptionWrapper(str(secure_key), self.active_conversation.salt)
-            decrypted_content = encryption_wrapper.decrypt(
-                self.active_conversation.data)
+            encryption_wrapper = conversation_wrapper(self.active_conversation)
+            decrypted_content = read_text(self.active_conversation, encryption_wrapper, Database.get_instance().get_cursor())
+            # what the revision saved next is a delta against
+            self.edit_base_text = decrypted_content
+            self.clear_blocks()
             self.text_edit.setText(decrypted_content)
             self.text_edit.setReadOnly(False)
         else:
             self.save_button.setDisabled(True)
-            encryption_wrapper = EncryptionWrapper(str(secure_key), self.active_conversation.salt)
-            decrypted_content = encryption_wrapper.decrypt(
-                self.active_conversation.data)
-            md = MarkdownIt()
-            formatter = HtmlFormatter(stylex="colorful")
-            md.renderer.rules['code'] = lambda tokens, idx, options, env, slf: \
-                '<div class="code-container">' \
-                '<pre class="highlight"><code>' + pygments.highlight(tokens[idx]['content'], md.lexer, formatter) + '</code></pre><button class="copy-button" onclick="copyCode(this)">Copy</button></div>'
-
-            html = md.render(decrypted_content)
-            self.text_edit.setHtml(html)
             self.text_edit.setReadOnly(True)
+            self.loader.show(self.active_conversation)
 
 
+    def show_history(self):
+        if self.active_conversation == None:
+            return
+        cursor = Database.get_instance().get_cursor()
+        revisions = Revision.get_headers(self.active_conversation.id, cursor)
+        if not revisions:
+            QMessageBox.information(self, "History", "No earlier versions saved yet.")
+            return
+        items = [f"{revision.number}: {revision.created_at}" for revision in revisions]
+        item, ok = QInputDialog.getItem(self, "History", "Restore version:", items, 0, False)
+        if not ok:
+            return
+        number = revisions[items.index(item)].number
+        if self.toggle_edit_button.isChecked() and self.text_edit.document().isModified():
+            answer = QMessageBox.question(self, "History", "Discard unsaved changes and load this version?")
+            if answer != QMessageBox.Yes:
+                return
+        salt = self.active_conversation.salt
+        text = load_revision(self.active_conversation.id, number, lambda kdf: EncryptionWrapper.get(str(secure_key), salt, kdf), cursor)
+        # restored into the editor, saving it makes it the newest revision
+        if not self.toggle_edit_button.isChecked():
+            self.toggle_edit_button.setChecked(True)
+            self.toggle_edit()
+        self.text_edit.setPlainText(text)
+
     def add_tags(self):
         if self.active_conversation == None:
             return
@@ -718,6 +1364,9 @@ class MainWindow(QMainWindow):
         self.refresh_tag_lists()
 
     def refresh_tag_lists(self):
+        # rebuilt for the counts, the include/exclude state carries over
+        tag_query = self.proxy_model.tag_query
+        self.tag_list.blockSignals(True)
         self.tag_list.clear()
         database = Database.get_instance()
         cursor = database.get_cursor()
@@ -725,18 +1374,67 @@ class MainWindow(QMainWindow):
         for tag in tags:
             item = QListWidgetItem(tag.name + "(" + str(tag.count) + ")")
             item.setData(Qt.UserRole, tag.id)
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable | Qt.ItemIsUserTristate)
+            if tag.id in tag_query.include:
+                self.set_tag_state(item, Qt.Checked)
+            elif tag.id in tag_query.exclude:
+                self.set_tag_state(item, Qt.PartiallyChecked)
+            else:
+                self.set_tag_state(item, Qt.Unchecked)
             self.tag_list.addItem(item)
+        self.tag_list.blockSignals(False)
+        # a deleted tag drops out of the filter
+        self.tag_selected()
+
+    def refresh_group_filter(self):
+        group_id = self.group_filter.currentData()
+        self.group_filter.blockSignals(True)
+        self.group_filter.clear()
+        self.group_filter.addItem("All groups", None)
+        database = Database.get_instance()
+        cursor = database.get_cursor()
+        for group in Group.get_all(cursor):
+            self.group_filter.addItem(group.name, group.id)
+        row = self.group_filter.findData(group_id)
+        self.group_filter.setCurrentIndex(row if row >= 0 else 0)
+        self.group_filter.blockSignals(False)
+        self.tag_selected()
+
+    # Qt cycles a tristate item unchecked, partially checked, checked. a tag
+    # is included on the first click and excluded on the second, so whatever
+    # Qt moved to is replaced by the state that should follow the previous one
+    TAG_STATE_AFTER = {
+        Qt.Unchecked: Qt.Checked,
+        Qt.Checked: Qt.PartiallyChecked,
+        Qt.PartiallyChecked: Qt.Unchecked,
+    }
+
+    def set_tag_state(self, item, state):
+        # the state is kept in the item too, itemChanged only tells the new one
+        item.setCheckState(state)
+        item.setData(Qt.UserRole + 1, state)
+
+    def tag_state_changed(self, item):
+        previous = item.data(Qt.UserRole + 1)
+        if item.checkState() == previous:
+            return
+        self.tag_list.blockSignals(True)
+        self.set_tag_state(item, self.TAG_STATE_AFTER.get(previous, item.checkState()))
+        self.tag_list.blockSignals(False)
+        self.tag_selected()
 
     def tag_selected(self):
-        if len(self.tag_list.selectedItems()) == 0:
-            self.proxy_model.tag_id = None
-            self.proxy_model.invalidateFilter()
-            return
-        item = self.tag_list.selectedItems()[0]
-        tag_id = item.data(Qt.UserRole)
-        self.proxy_model.tag_id = tag_id
-        self.proxy_model.invalidateFilter()
-        window.tree_view.expandAll()
+        include, exclude = [], []
+        for i in range(self.tag_list.count()):
+            item = self.tag_list.item(i)
+            if item.checkState() == Qt.Checked:
+                include.append(item.data(Qt.UserRole))
+            elif item.checkState() == Qt.PartiallyChecked:
+                exclude.append(item.data(Qt.UserRole))
+        group_id = self.group_filter.currentData()
+        tag_query = TagQuery(include, exclude, self.tag_mode.currentData(), [group_id] if group_id != None else [])
+        if tag_query != self.proxy_model.tag_query:
+            self.proxy_model.setTagQuery(tag_query)
     
     def handle_tag_selected(self, action):
         if self.active_conversation == None:
@@ -772,63 +1470,89 @@ class MainWindow(QMainWindow):
             database.conn.commit()
 
             self.tree_model.group_added(group)
+            self.refresh_group_filter()
 
     def import_history(self):
         file_dialog = QFileDialog(self)
         file_dialog.setNameFilter("Markdown files (*.md)")
-        file_dialog.setFileMode(QFileDialog.ExistingFile)
+        file_dialog.setFileMode(QFileDialog.ExistingFiles)
 
         if file_dialog.exec():
-            file_name = file_dialog.selectedFiles()[0]
-            with open(file_name, "r", encoding="utf-8") as f:
-                content = f.read()
-
-                lines = content.split("\n")
-                if lines:
-                    title = lines[0].lstrip('#').strip()  # Extract the title
-                    # Store the remaining content
-                    remaining_content = '\n'.join(lines[1:])
-
-                    group_dialog = GroupSelectionDialog()
+            self.start_import(file_dialog.selectedFiles())
 
-                    # check if group_dialog.selected_group_id exists
-                    if group_dialog.selected_group_id == None:
-                        return
+    def import_directory(self):
+        directory = QFileDialog.getExistingDirectory(self, "Import directory")
+        if directory:
+            self.start_import(find_markdown_files(directory))
 
-                    group_id = group_dialog.selected_group_id 
-
-                    salt = EncryptionWrapper.generate_salt()
-                    encryption_wrapper = EncryptionWrapper(str(secure_key), salt)
-                    encrypted_content = encryption_wrapper.encrypt(
-                        remaining_content)
-                    database = Database.get_instance()
-                    cursor = database.get_cursor()
-                    conversation = Conversation(
-                        None, title, group_id, encrypted_content, None, salt)
-                    conversation_id = Conversation.add(conversation, cursor)
-                    database.conn.commit()
-                    conversation.id = conversation_id
-                    self.tree_model.conversation_added(conversation)
+    def import_export(self):
+        # conversations.json from the official data export
+        file_name, _ = QFileDialog.getOpenFileName(self, "Import ChatGPT export", "", "ChatGPT export (conversations.json);;JSON files (*.json)")
+        if not file_name or not self.can_start_import():
+            return
+        group_dialog = GroupSelectionDialog()
+        if group_dialog.selected_group_id == None:
+            return
 
-                    retrieved_conversation = Conversation.get_by_id(
-                        conversation_id, cursor)
-                    new_encryption_wrapper = EncryptionWrapper(
-                        str(secure_key), retrieved_conversation.salt)
-                    decrypted_content = new_encryption_wrapper.decrypt(
-                        retrieved_conversation.data)
+        self.batch_import = ExportImport(db_path, str(secure_key), file_name, group_dialog.selected_group_id, kdf_version, parent=self)
+        self.batch_import.progress.connect(self.export_import_progress)
+        self.batch_import.finished.connect(self.import_finished)
+        self.statusBar().showMessage("Importing export...")
+        self.batch_import.start()
 
+    def can_start_import(self):
+        if self.batch_import != None:
+            self.statusBar().showMessage("An import is still running")
+            return False
+        return True
 
-                    md = MarkdownIt()
-                    formatter = HtmlFormatter(stylex="colorful")
-                    md.renderer.rules['code'] = lambda tokens, idx, options, env, slf: \
-                        '<div class="code-container">' \
-                        '<pre class="highlight"><code>' + pygments.highlight(tokens[idx]['content'], md.lexer, formatter) + '</code></pre><button class="copy-button" onclick="copyCode(this)">Copy</button></div>'
-                    
-                    window.update_active_conversation(retrieved_conversation)
+    def start_import(self, paths):
+        if not paths or not self.can_start_import():
+            return
+        # one group for the whole batch
+        group_dialog = GroupSelectionDialog()
+        if group_dialog.selected_group_id == None:
+            return
 
-                    html = md.render(decrypted_content)
-                    self.text_edit.setHtml(html)                   
-                    self.text_edit.setReadOnly(True)
+        self.batch_import = BatchImport(db_path, str(secure_key), paths, group_dialog.selected_group_id, kdf_version, parent=self)
+        self.batch_import.progress.connect(self.import_progress)
+        self.batch_import.finished.connect(self.import_finished)
+        self.statusBar().showMessage(f"Importing {len(paths)} files...")
+        self.batch_import.start()
+
+    def import_progress(self, done, total):
+        self.statusBar().showMessage(f"Encrypted {done} of {total} files")
+
+    def export_import_progress(self, imported, percent):
+        self.statusBar().showMessage(f"Imported {imported} conversations ({percent}%)")
+
+    def import_finished(self):
+        batch_import = self.batch_import
+        self.batch_import = None
+        imported = batch_import.imported
+        if batch_import.error != None:
+            QMessageBox.warning(self, "Import failed", batch_import.error)
+            # an export is committed batch by batch, show what made it in
+            if imported:
+                self.tree_model.update_data()
+            return
+        if len(imported) > self.tree_model.page_size:
+            self.tree_model.update_data()
+        else:
+            for conversation in imported:
+                self.tree_model.insert_conversation(conversation.group_id, conversation)
+        message = f"Imported {len(imported)} conversations"
+        if batch_import.duplicates:
+            message += f", skipped {batch_import.duplicates} already in the database"
+        if batch_import.failed:
+            message += f", {len(batch_import.failed)} files could not be read"
+        self.statusBar().showMessage(message)
+        if len(imported) == 1:
+            self.loader.load(imported[0].id)
+
+    def stop_import(self):
+        if self.batch_import != None:
+            self.batch_import.stop()
 
 class PasswordDialog(QDialog):
     def __init__(self):
@@ -1061,6 +1785,7 @@ class DbManager(QDialog):
                     Metadata.add(blob, cursor)
                     salt = Metadata(None, "salt", salt)
                     Metadata.add(salt, cursor)
+                    Metadata.add(Metadata(None, "kdf_version", str(KDF_HKDF)), cursor)
                     database.conn.commit()
                 else:
                     sys.exit(0)
@@ -1081,7 +1806,12 @@ class DbManager(QDialog):
 
 
 if __name__ == "__main__":
+    # the brute force search runs in worker processes, frozen builds need this
+    multiprocessing.freeze_support()
     secure_key = None
+    kdf_version = KDF_HKDF
+    render_cache = None
+    search_index = None
 
     app = QApplication([])
 
@@ -1134,15 +1864,36 @@ if __name__ == "__main__":
     
     database = Database.get_instance()
     cursor = database.get_cursor()
-    groups = Group.get_all(cursor)
-    
-    # populate group in to data
-    data = {}
-    for group in groups:
-        conversations = Conversation.get_by_group_id(group.id, cursor)
-        data[f"{group.id}-{group.name}"] = [{"title": conversation.title, "id": conversation.id} for conversation in conversations]
+
+    # databases from before kdf_version existed switch to hkdf for new rows,
+    # old rows are converted in the background
+    if Metadata.get_value("kdf_version", cursor) == None:
+        Metadata.add(Metadata(None, "kdf_version", str(KDF_HKDF)), cursor)
+        database.conn.commit()
+    kdf_version = int(Metadata.get_value("kdf_version", cursor))
+
+    # keeping encrypted renderings on disk is opt in, it trades file size for speed
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    persist_render_cache = config.getboolean("app", "persist_render_cache", fallback=False)
+    render_cache = RenderCache(persist=persist_render_cache)
+
+    search_index = SearchIndex(str(secure_key))
+    content_hasher = ContentHasher(str(secure_key))
+
+    maintenance = MaintenanceThread(db_path, [KdfMigration(str(secure_key)), PayloadConversion(str(secure_key)), SearchIndexBackfill(str(secure_key), search_index), ContentHashBackfill(str(secure_key), content_hasher), MessageSplit(str(secure_key), content_hasher)])
+    maintenance.start()
 
     header_labels = ["Groups"]
-    window = MainWindow(header_labels, data)
+    window = MainWindow(header_labels)
     window.show()
+    # stop background work before forgetting the master key and every derived key
+    app.aboutToQuit.connect(maintenance.stop)
+    app.aboutToQuit.connect(window.loader.stop)
+    app.aboutToQuit.connect(window.stop_search)
+    app.aboutToQuit.connect(window.stop_import)
+    app.aboutToQuit.connect(render_cache.clear)
+    app.aboutToQuit.connect(search_index.wipe)
+    app.aboutToQuit.connect(content_hasher.wipe)
+    app.aboutToQuit.connect(secure_key.wipe)
     app.exec()
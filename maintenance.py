@@ -0,0 +1,196 @@
+import sqlite3
+from cryptography.fernet import InvalidToken
+from PySide6.QtCore import QThread, Signal
+from crytpo import EncryptionWrapper, KDF_PBKDF2, KDF_HKDF, is_legacy_payload, new_messages_marker
+from db import Conversation
+from messages import read_text, store_messages
+from renderer import RenderCache
+
+# Background upkeep that rewrites old rows in small batches, off the ui thread.
+# Every task works on its own sqlite connection and only updates a row if it
+# hasn't changed since it was read, so it never fights with a save in the ui.
+
+class KdfMigration:
+    # re-encrypt conversations still keyed with pbkdf2 under an hkdf key
+    name = "kdf"
+
+    def __init__(self, password):
+        self.password = password
+        self.last_id = 0
+
+    def run_batch(self, conn, batch_size):
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, data, salt FROM conversations WHERE kdf=? AND id>? ORDER BY id LIMIT ?", (KDF_PBKDF2, self.last_id, batch_size))
+        rows = cursor.fetchall()
+        updates = []
+        for id, data, salt in rows:
+            self.last_id = id
+            # each key is used exactly once here, keep them out of the session cache
+            old_wrapper = EncryptionWrapper(self.password, salt, KDF_PBKDF2)
+            new_wrapper = EncryptionWrapper(self.password, salt, KDF_HKDF)
+            try:
+                plaintext = old_wrapper.decrypt(data)
+            except InvalidToken:
+                # leave unreadable rows alone, skipping them keeps the batch going
+                continue
+            updates.append((new_wrapper.encrypt(plaintext), KDF_HKDF, id, data))
+
+        cursor.executemany("UPDATE conversations SET data=?, kdf=? WHERE id=? AND data=?", updates)
+        conn.commit()
+        return len(rows)
+
+
+class SearchIndexBackfill:
+    # build search tokens for conversations that predate the search index
+    name = "search"
+
+    def __init__(self, password, search_index):
+        self.password = password
+        self.search_index = search_index
+        self.last_id = 0
+
+    def run_batch(self, conn, batch_size):
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, data, salt, kdf FROM conversations WHERE indexed=0 AND deleted=0 AND id>? ORDER BY id LIMIT ?", (self.last_id, batch_size))
+        rows = cursor.fetchall()
+        for id, data, salt, kdf in rows:
+            self.last_id = id
+            try:
+                plaintext = read_text(Conversation(id, None, None, data, None, salt, kdf), EncryptionWrapper(self.password, salt, kdf), cursor)
+            except InvalidToken:
+                continue
+            self.search_index.index(id, plaintext, cursor)
+            # the write above holds the lock, so this read can't race a save.
+            # if the row was edited meanwhile the save indexed it already
+            cursor.execute("SELECT data FROM conversations WHERE id=?", (id,))
+            if cursor.fetchone()[0] == data:
+                conn.commit()
+            else:
+                conn.rollback()
+        return len(rows)
+
+
+class ContentHashBackfill:
+    # hash conversations imported before content hashes, so re-importing
+    # them is caught too
+    name = "content hash"
+
+    def __init__(self, password, content_hasher):
+        self.password = password
+        self.content_hasher = content_hasher
+        self.last_id = 0
+
+    def run_batch(self, conn, batch_size):
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, data, salt, kdf FROM conversations WHERE content_hash IS NULL AND deleted=0 AND id>? ORDER BY id LIMIT ?", (self.last_id, batch_size))
+        rows = cursor.fetchall()
+        updates = []
+        for id, data, salt, kdf in rows:
+            self.last_id = id
+            try:
+                plaintext = read_text(Conversation(id, None, None, data, None, salt, kdf), EncryptionWrapper(self.password, salt, kdf), cursor)
+            except InvalidToken:
+                continue
+            updates.append((self.content_hasher.digest(plaintext), id, data))
+
+        cursor.executemany("UPDATE conversations SET content_hash=? WHERE id=? AND data=?", updates)
+        conn.commit()
+        return len(rows)
+
+
+class PayloadConversion:
+    # rewrite base64 fernet tokens in the compressed binary format.
+    # runs after KdfMigration, which already rewrote the rows it touched
+    name = "payload"
+
+    def __init__(self, password):
+        self.password = password
+        self.last_id = 0
+
+    def run_batch(self, conn, batch_size):
+        cursor = conn.cursor()
+        # hex() reads the first byte the same whether it's stored as text or blob
+        cursor.execute("SELECT id, data, salt, kdf FROM conversations WHERE hex(substr(data, 1, 1))='67' AND id>? ORDER BY id LIMIT ?", (self.last_id, batch_size))
+        rows = cursor.fetchall()
+        updates = []
+        render_updates = []
+        for id, data, salt, kdf in rows:
+            self.last_id = id
+            if not is_legacy_payload(data):
+                continue
+            # one use per key again, don't push the session's keys out of the cache
+            wrapper = EncryptionWrapper(self.password, salt, kdf)
+            try:
+                plaintext = wrapper.decrypt(data)
+            except InvalidToken:
+                continue
+            new_data = wrapper.encrypt(plaintext)
+            updates.append((new_data, id, data))
+            # the cached html is still readable, it only has to follow the new data
+            render_updates.append((RenderCache.data_hash(new_data), id, RenderCache.data_hash(data)))
+
+        cursor.executemany("UPDATE conversations SET data=? WHERE id=? AND data=?", updates)
+        cursor.executemany("UPDATE render_cache SET data_hash=? WHERE conversation_id=? AND data_hash=?", render_updates)
+        conn.commit()
+        return len(rows)
+
+
+class MessageSplit:
+    # move conversations stored as one body into messages (messages.py).
+    # last in line, by then the other tasks are done with the bodies
+    name = "messages"
+
+    def __init__(self, password, content_hasher):
+        self.password = password
+        self.content_hasher = content_hasher
+        self.last_id = 0
+
+    def run_batch(self, conn, batch_size):
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, data, salt, kdf FROM conversations WHERE hex(substr(data, 1, 1))!='05' AND kdf=? AND deleted=0 AND id>? ORDER BY id LIMIT ?", (KDF_HKDF, self.last_id, batch_size))
+        rows = cursor.fetchall()
+        for id, data, salt, kdf in rows:
+            self.last_id = id
+            wrapper = EncryptionWrapper(self.password, salt, kdf)
+            try:
+                plaintext = wrapper.decrypt(data)
+            except InvalidToken:
+                continue
+            store_messages(id, plaintext, wrapper, self.content_hasher, cursor, rewrite=True)
+            marker = new_messages_marker()
+            cursor.execute("UPDATE conversations SET data=? WHERE id=? AND data=?", (marker, id, data))
+            # a save got there first, it wrote the messages itself
+            if cursor.rowcount == 1:
+                cursor.execute("UPDATE render_cache SET data_hash=? WHERE conversation_id=? AND data_hash=?", (RenderCache.data_hash(marker), id, RenderCache.data_hash(data)))
+                conn.commit()
+            else:
+                conn.rollback()
+        return len(rows)
+
+
+class MaintenanceThread(QThread):
+    progress = Signal(str, int)
+
+    def __init__(self, db_path, tasks, batch_size=20, parent=None):
+        super().__init__(parent)
+        self.db_path = db_path
+        self.tasks = tasks
+        self.batch_size = batch_size
+
+    def run(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            for task in self.tasks:
+                while not self.isInterruptionRequested():
+                    processed = task.run_batch(conn, self.batch_size)
+                    if processed == 0:
+                        break
+                    self.progress.emit(task.name, processed)
+                    # give the ui thread a window to take the write lock
+                    self.msleep(20)
+        finally:
+            conn.close()
+
+    def stop(self):
+        self.requestInterruption()
+        self.wait()
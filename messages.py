@@ -0,0 +1,74 @@
+import re
+from crytpo import is_messages_marker
+from db import Message
+
+# Conversations stored a message at a time.
+# A conversation's markdown is cut before every heading that names a speaker
+# ("## User", "## ChatGPT", ...) and every piece is its own row in messages,
+# encrypted with the conversation's key. Joined back together the pieces are
+# the markdown again, byte for byte. Such a conversation keeps only a marker
+# in conversations.data (crytpo.new_messages_marker).
+
+ROLE_RE = re.compile(r"#{1,6}[ \t]*(user|you|chatgpt|assistant|tool|system)[ \t]*:?[ \t]*$", re.IGNORECASE)
+ROLES = {"user": "user", "you": "user", "chatgpt": "assistant", "assistant": "assistant", "tool": "tool", "system": "system"}
+
+def split_messages(text):
+    # [(role, body)], role is None for whatever comes before the first heading
+    parts = []
+    role = None
+    start = 0
+    position = 0
+    in_fence = False
+    for line in text.splitlines(keepends=True):
+        stripped = line.strip()
+        if stripped.startswith("```") or stripped.startswith("~~~"):
+            in_fence = not in_fence
+        elif not in_fence:
+            match = ROLE_RE.match(stripped)
+            if match:
+                if position > start:
+                    parts.append((role, text[start:position]))
+                    start = position
+                role = ROLES[match.group(1).lower()]
+        position += len(line)
+    if start < len(text) or not parts:
+        parts.append((role, text[start:]))
+    return parts
+
+def encrypt_messages(text, wrapper, content_hasher):
+    # [(role, data, content_hash)] for a conversation that has no messages yet
+    return [(role, wrapper.encrypt(body), content_hasher.digest(body, normalize=False)) for role, body in split_messages(text)]
+
+def iter_text(conversation, wrapper, cursor, batch_size=50):
+    # the markdown in pieces as it's decrypted, whichever way it's stored.
+    # messages are fetched a range at a time, never all at once
+    if not is_messages_marker(conversation.data):
+        yield from wrapper.decrypt_iter(conversation.data)
+        return
+    start = 0
+    while True:
+        messages = Message.get_range(conversation.id, start, batch_size, cursor)
+        for message in messages:
+            yield from wrapper.decrypt_iter(message.data)
+        if len(messages) < batch_size:
+            return
+        start = messages[-1].ordinal + 1
+
+def read_text(conversation, wrapper, cursor):
+    return "".join(iter_text(conversation, wrapper, cursor))
+
+def store_messages(conversation_id, text, wrapper, content_hasher, cursor, rewrite=False):
+    # save text as the conversation's messages. only messages whose role or
+    # body changed are encrypted and written, unless rewrite is set (new key,
+    # or the conversation wasn't stored per message before).
+    # returns how many were written
+    parts = split_messages(text)
+    existing = {} if rewrite else Message.get_hashes(conversation_id, cursor)
+    changed = []
+    for ordinal, (role, body) in enumerate(parts):
+        content_hash = content_hasher.digest(body, normalize=False)
+        if existing.get(ordinal) != (role, content_hash):
+            changed.append(Message(conversation_id, ordinal, role, wrapper.encrypt(body), content_hash))
+    Message.save_many(changed, cursor)
+    Message.delete_from(conversation_id, len(parts), cursor)
+    return len(changed)
@@ -0,0 +1,151 @@
+from collections import OrderedDict
+from html import escape
+import hashlib, sys, threading
+from markdown_it import MarkdownIt
+import pygments
+from pygments.formatters import HtmlFormatter
+from pygments.lexers import get_lexer_by_name
+from pygments.util import ClassNotFound
+from db import RenderedHtml
+
+# rendered html is cut into blocks of about this much markdown, marked with
+# BLOCK_SEPARATOR, so the viewer can lay out the first blocks and add the
+# rest as they're needed instead of swallowing a huge conversation in one go.
+# the separator is a NUL, markdown-it replaces those in its input so no
+# conversation can render one, raw html included
+BLOCK_CHARS = 8 * 1024
+BLOCK_SEPARATOR = "\x00"
+
+def split_blocks(html):
+    # the newline after a block's last tag turns into a trailing space when
+    # the block is inserted on its own
+    return [block.strip() for block in html.split(BLOCK_SEPARATOR)]
+
+class MarkdownRenderer:
+    # one MarkdownIt and one HtmlFormatter for the whole app, building them is
+    # not free and nothing about them changes between conversations
+    _instance = None
+
+    @classmethod
+    def get_instance(cls):
+        if not cls._instance:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        self.md = MarkdownIt()
+        # qtextedit doesn't load stylesheets for classes, so the colours go inline.
+        # we wrap the output in our own pre/code below.
+        self.formatter = HtmlFormatter(style="colorful", noclasses=True, nowrap=True)
+        self._lexers = {}
+        self.md.renderer.rules['fence'] = self.render_fence
+        self.md.renderer.rules['code_block'] = self.render_fence
+
+    def get_lexer(self, language):
+        # lexer lookup walks pygments' plugin registry, only do it once per name.
+        # unknown names are cached too, as None
+        if language not in self._lexers:
+            try:
+                self._lexers[language] = get_lexer_by_name(language)
+            except ClassNotFound:
+                self._lexers[language] = None
+        return self._lexers[language]
+
+    def render_fence(self, tokens, idx, options, env):
+        token = tokens[idx]
+        info = token.info.strip().split() if token.info else []
+        lexer = self.get_lexer(info[0].lower()) if info else None
+        if lexer != None:
+            code = pygments.highlight(token.content, lexer, self.formatter)
+        else:
+            code = escape(token.content)
+        return '<div class="code-container">' \
+            '<pre class="highlight"><code>' + code + '</code></pre><button class="copy-button" onclick="copyCode(this)">Copy</button></div>'
+
+    def render(self, content, block_chars=BLOCK_CHARS):
+        # parse once and render the top level blocks in groups, references and
+        # footnotes still resolve across the whole document
+        env = {}
+        tokens = self.md.parse(content, env)
+        blocks = []
+        start = 0
+        size = 0
+        for i, token in enumerate(tokens):
+            size += len(token.content)
+            # a top level block ends with its closing token, or is a single token
+            if token.level == 0 and token.nesting <= 0 and size >= block_chars:
+                blocks.append(self.md.renderer.render(tokens[start:i + 1], self.md.options, env))
+                start = i + 1
+                size = 0
+        if start < len(tokens) or not blocks:
+            blocks.append(self.md.renderer.render(tokens[start:], self.md.options, env))
+        return BLOCK_SEPARATOR.join(blocks)
+
+
+def render_markdown(content):
+    return MarkdownRenderer.get_instance().render(content)
+
+class RenderCache:
+    # rendered html per conversation, tagged with a hash of the encrypted data
+    # it was rendered from, so an edited conversation misses without anyone
+    # having to invalidate it.
+    # bounded by the memory held by the cached strings, oldest out first.
+    # shared between the ui thread and the loader threads.
+    def __init__(self, max_bytes=64 * 1024 * 1024, persist=False):
+        self.max_bytes = max_bytes
+        self.persist = persist
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def data_hash(data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return hashlib.sha256(data).hexdigest()
+
+    def get(self, conversation, wrapper=None, cursor=None):
+        data_hash = self.data_hash(conversation.data)
+        with self._lock:
+            entry = self._entries.get(conversation.id)
+            if entry != None and entry[0] == data_hash:
+                self._entries.move_to_end(conversation.id)
+                return entry[1]
+
+        if self.persist and wrapper != None and cursor != None:
+            rendered = RenderedHtml.get_by_conversation_id(conversation.id, cursor)
+            if rendered != None and rendered.data_hash == data_hash:
+                html = wrapper.decrypt(rendered.html)
+                self._store(conversation.id, data_hash, html)
+                return html
+        return None
+
+    def put(self, conversation, html, wrapper=None, cursor=None):
+        data_hash = self.data_hash(conversation.data)
+        self._store(conversation.id, data_hash, html)
+
+        if self.persist and wrapper != None and cursor != None:
+            rendered = RenderedHtml(conversation.id, data_hash, wrapper.encrypt(html))
+            RenderedHtml.save(rendered, cursor)
+
+    def _store(self, conversation_id, data_hash, html):
+        with self._lock:
+            self.invalidate(conversation_id)
+            size = sys.getsizeof(html)
+            if size > self.max_bytes:
+                return
+            self._entries[conversation_id] = (data_hash, html)
+            self.size += size
+            while self.size > self.max_bytes:
+                self.invalidate(next(iter(self._entries)))
+
+    def invalidate(self, conversation_id):
+        with self._lock:
+            entry = self._entries.pop(conversation_id, None)
+            if entry != None:
+                self.size -= sys.getsizeof(entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
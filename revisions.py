@@ -0,0 +1,88 @@
+from difflib import SequenceMatcher
+from db import Revision
+import json
+
+# Earlier versions of a conversation, kept on every save.
+# A revision is either the whole text (a snapshot) or a delta against the
+# revision before it, both encrypted with the conversation's key. Saving a
+# small edit writes a delta of a few hundred bytes, a snapshot is written
+# every SNAPSHOT_EVERY revisions so restoring never replays a long chain.
+# The first save of a conversation also keeps the text it started from.
+
+SNAPSHOT_EVERY = 20
+
+def make_delta(old, new):
+    # ops on lines: a positive int copies that many lines of old, a negative
+    # int skips them, a string is inserted as is
+    a = old.splitlines(keepends=True)
+    b = new.splitlines(keepends=True)
+    # edits are usually in one place, the matcher only has to look at that
+    prefix = 0
+    while prefix < len(a) and prefix < len(b) and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < len(a) - prefix and suffix < len(b) - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+
+    ops = [prefix] if prefix else []
+    matcher = SequenceMatcher(None, a[prefix:len(a) - suffix], b[prefix:len(b) - suffix])
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append(i2 - i1)
+            continue
+        if i2 > i1:
+            ops.append(i1 - i2)
+        if j2 > j1:
+            ops.append("".join(b[prefix + j1:prefix + j2]))
+    if suffix:
+        ops.append(suffix)
+    return ops
+
+def apply_delta(old, ops):
+    lines = old.splitlines(keepends=True)
+    position = 0
+    pieces = []
+    for op in ops:
+        if isinstance(op, str):
+            pieces.append(op)
+        elif op > 0:
+            pieces.extend(lines[position:position + op])
+            position += op
+        else:
+            position -= op
+    return "".join(pieces)
+
+def record_revision(conversation_id, previous_text, text, wrapper, kdf, content_hasher, cursor):
+    # called on save, in the same transaction. previous_text is what the
+    # editor started from. returns the new revision number, None when
+    # nothing changed
+    if text == previous_text:
+        return None
+    last = Revision.get_last(conversation_id, cursor)
+    previous_hash = content_hasher.digest(previous_text, normalize=False)
+    if last == None or last.content_hash != previous_hash:
+        # first save, or the conversation changed without a revision (an
+        # import, a restore from an older build), start the chain over
+        number = last.number + 1 if last != None else 0
+        Revision.add(Revision(conversation_id, number, True, wrapper.encrypt(previous_text), kdf, previous_hash), cursor)
+        last_snapshot = number
+    else:
+        number = last.number
+        last_snapshot = Revision.get_last_snapshot_number(conversation_id, cursor)
+
+    number += 1
+    delta = json.dumps(make_delta(previous_text, text), ensure_ascii=False, separators=(",", ":"))
+    # a rewrite of most of the text is cheaper to keep whole
+    snapshot = number - last_snapshot >= SNAPSHOT_EVERY or len(delta) > len(text) // 2
+    data = wrapper.encrypt(text if snapshot else delta)
+    Revision.add(Revision(conversation_id, number, snapshot, data, kdf, content_hasher.digest(text, normalize=False)), cursor)
+    return number
+
+def load_revision(conversation_id, number, wrapper_for, cursor):
+    # the text of a revision. wrapper_for(kdf) gives the conversation's
+    # wrapper for a key scheme, older revisions may predate a migration
+    text = None
+    for revision in Revision.get_chain(conversation_id, number, cursor):
+        plaintext = wrapper_for(revision.kdf).decrypt(revision.data)
+        text = plaintext if revision.snapshot else apply_delta(text, json.loads(plaintext))
+    return text
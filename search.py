@@ -0,0 +1,170 @@
+from cryptography.fernet import InvalidToken
+from cryptography.hazmat.primitives import hashes, hmac
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from PySide6.QtCore import QThread, Signal
+from crytpo import EncryptionWrapper, is_messages_marker
+from db import Message
+import re, sqlite3, os, time
+
+# Blind index for global search.
+# Every distinct word of a conversation is stored as a keyed hmac, never as
+# text, so the database only learns which conversations share a word, not
+# what the word is. A query is blinded the same way and looked up by token.
+
+# single characters count, "world 3" must not find every "world"
+WORD_RE = re.compile(r"\w+")
+MIN_WORD_LENGTH = 1
+MAX_WORD_LENGTH = 64
+TOKEN_LENGTH = 16
+
+def tokenize(text):
+    words = set()
+    for match in WORD_RE.finditer(text):
+        word = match.group().casefold()
+        if MIN_WORD_LENGTH <= len(word) <= MAX_WORD_LENGTH:
+            words.add(word)
+    return words
+
+
+class SearchIndex:
+    def __init__(self, password):
+        kdf = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b'chatgpt-history search',
+        )
+        self.key = kdf.derive(password.encode('utf-8'))
+
+    def blind(self, word):
+        h = hmac.HMAC(self.key, hashes.SHA256())
+        h.update(word.encode('utf-8'))
+        return h.finalize()[:TOKEN_LENGTH]
+
+    def tokens(self, text):
+        return [self.blind(word) for word in tokenize(text)]
+
+    def index(self, conversation_id, text, cursor):
+        cursor.execute("DELETE FROM search_token WHERE conversation_id=?", (conversation_id,))
+        self.store([(conversation_id, self.tokens(text))], cursor)
+
+    @classmethod
+    def store(cls, entries, cursor):
+        # entries is a list of (conversation_id, tokens) for conversations
+        # without tokens yet, e.g. tokens blinded in import worker processes
+        cursor.executemany("INSERT INTO search_token (token, conversation_id) VALUES (?, ?)", [(token, conversation_id) for conversation_id, tokens in entries for token in tokens])
+        cursor.executemany("UPDATE conversations SET indexed=1 WHERE id=?", [(conversation_id,) for conversation_id, tokens in entries])
+
+    def search(self, query, cursor, limit=500):
+        # every word of the query has to be in the conversation
+        tokens = self.tokens(query)
+        if not tokens:
+            return []
+        placeholders = ", ".join("?" for _ in tokens)
+        cursor.execute(f"""SELECT c.id, c.title, c.group_id FROM conversations c
+                           INNER JOIN (SELECT conversation_id FROM search_token WHERE token IN ({placeholders})
+                                       GROUP BY conversation_id HAVING COUNT(DISTINCT token)=?) m ON m.conversation_id=c.id
+                           WHERE c.deleted=0 ORDER BY c.id DESC LIMIT ?""", (*tokens, len(tokens), limit))
+        return cursor.fetchall()
+
+    @classmethod
+    def is_complete(cls, cursor):
+        cursor.execute("SELECT COUNT(*) FROM conversations WHERE indexed=0 AND deleted=0")
+        return cursor.fetchone()[0] == 0
+
+    def wipe(self):
+        self.key = None
+
+
+# Brute force search, for databases whose index isn't complete yet.
+# Rows are streamed out of sqlite in chunks and every chunk is decrypted and
+# matched in a worker process. The workers get the master key once, when
+# they start, and keep their derived keys in their own EncryptionWrapper cache.
+
+_worker_password = None
+
+def _init_worker(password):
+    global _worker_password
+    _worker_password = password
+
+def _match_chunk(rows, words):
+    # data is a list, the messages of a conversation stored per message.
+    # words is tokenize(query), matched the way the index matches them
+    hits = []
+    for id, title, group_id, data, salt, kdf in rows:
+        wrapper = EncryptionWrapper.get(_worker_password, salt, kdf)
+        try:
+            plaintext = "".join(wrapper.decrypt(part) for part in data)
+        except InvalidToken:
+            continue
+        if tokenize(plaintext) >= words:
+            hits.append((id, title, group_id))
+    return hits, len(rows)
+
+
+class BruteForceSearch(QThread):
+    hits = Signal(object)
+    progress = Signal(int, float)
+
+    def __init__(self, db_path, password, query, chunk_size=50, parent=None):
+        super().__init__(parent)
+        self.db_path = db_path
+        self.password = password
+        self.words = tokenize(query)
+        self.chunk_size = chunk_size
+
+    def run(self):
+        # nothing the index could look up either
+        if not self.words:
+            return
+        workers = os.cpu_count() or 2
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self.password,))
+        try:
+            cursor = conn.cursor()
+            pending = set()
+            scanned = 0
+            started = time.monotonic()
+            exhausted = False
+            last_id = None
+            while not self.isInterruptionRequested():
+                # keep every worker busy without pulling the whole table into memory.
+                # one short query per chunk, a long running select would hold a
+                # read lock and keep the ui from saving
+                while not exhausted and len(pending) < workers * 2:
+                    if last_id == None:
+                        cursor.execute("SELECT id, title, group_id, data, salt, kdf FROM conversations WHERE deleted=0 ORDER BY id DESC LIMIT ?", (self.chunk_size,))
+                    else:
+                        cursor.execute("SELECT id, title, group_id, data, salt, kdf FROM conversations WHERE deleted=0 AND id<? ORDER BY id DESC LIMIT ?", (last_id, self.chunk_size))
+                    rows = cursor.fetchall()
+                    if not rows:
+                        exhausted = True
+                        break
+                    last_id = rows[-1][0]
+                    rows = [(id, title, group_id, self.bodies(id, data, cursor), salt, kdf) for id, title, group_id, data, salt, kdf in rows]
+                    pending.add(pool.submit(_match_chunk, rows, self.words))
+                if not pending:
+                    break
+
+                done, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+                for future in done:
+                    hits, count = future.result()
+                    scanned += count
+                    if hits:
+                        self.hits.emit(hits)
+                if done:
+                    elapsed = max(time.monotonic() - started, 0.001)
+                    self.progress.emit(scanned, scanned / elapsed)
+        finally:
+            pool.shutdown(wait=False, cancel_futures=True)
+            conn.close()
+
+    def bodies(self, conversation_id, data, cursor):
+        if is_messages_marker(data):
+            return [message.data for message in Message.get_by_conversation_id(conversation_id, cursor)]
+        return [data]
+
+    def stop(self):
+        self.requestInterruption()
+        self.wait()
@@ -160,10 +160,6 @@ class ManageTagsDialog(QDialog):
             database = Database.get_instance()
             cursor = database.get_cursor()
 
-            conversations = Conversation.get_by_tag_id(tag_id, cursor)
-            for conversation in conversations:
-                Conversation.remove_tag(conversation.id, tag_id, cursor)
-
             Tag.delete(tag_id, cursor)
             database.conn.commit()
             self.tag_list.takeItem(self.tag_list.row(item))
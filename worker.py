@@ -0,0 +1,186 @@
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Signal
+import sys
+from crytpo import EncryptionWrapper, is_messages_marker
+from db import Conversation, Message, Tag
+from renderer import render_markdown
+from messages import iter_text
+
+# how much text of a big conversation is shown before the rest is decrypted
+PREVIEW_CHARS = 16 * 1024
+
+def preview_text(pieces, limit=PREVIEW_CHARS):
+    # the first limit characters, cut at a paragraph so a half open code
+    # block or list doesn't swallow the rest of the preview
+    text = ""
+    for piece in pieces:
+        text += piece[:limit - len(text)]
+        if len(text) >= limit:
+            break
+    cut = text.rfind("\n\n")
+    return text[:cut] if cut > 0 else text
+
+def load_html(conversation, wrapper, render_cache, conn, preview=None):
+    # only decrypt and render when the cache has nothing for this exact data.
+    # preview, if given, gets the html of the beginning of a conversation
+    # that is decrypted in chunks, before the rest is done
+    cursor = conn.cursor()
+    html = render_cache.get(conversation, wrapper, cursor)
+    if html == None:
+        pieces = []
+        size = 0
+        for piece in iter_text(conversation, wrapper, cursor):
+            # only once there's more to come, a conversation that arrives in
+            # one piece is rendered once
+            if preview != None and size >= PREVIEW_CHARS:
+                if not preview(render_markdown(preview_text(pieces))):
+                    return None
+                preview = None
+            pieces.append(piece)
+            size += len(piece)
+        html = render_markdown("".join(pieces))
+        del pieces
+        render_cache.put(conversation, html, wrapper, cursor)
+        conn.commit()
+    return html
+
+
+class LoadTask(QRunnable):
+    def __init__(self, loader, generation, conversation_id=None, conversation=None):
+        super().__init__()
+        self.loader = loader
+        self.generation = generation
+        self.conversation_id = conversation_id
+        self.conversation = conversation
+
+    def cancelled(self):
+        return self.generation != self.loader.generation
+
+    def run(self):
+        if self.cancelled():
+            return
+        try:
+            conn = self.loader.database.get_thread_connection()
+            conversation = self.conversation
+            if conversation == None:
+                cursor = conn.cursor()
+                conversation = Conversation.get_by_id(self.conversation_id, cursor)
+                conversation.tags = Tag.get_by_conversation_id(conversation.id, cursor)
+            if self.cancelled():
+                return
+
+            wrapper = EncryptionWrapper.get(self.loader.password, conversation.salt, conversation.kdf)
+            html = load_html(conversation, wrapper, self.loader.render_cache, conn, self.preview)
+        except Exception as e:
+            self.loader.failed.emit(self.generation, str(e))
+            return
+        if html == None:
+            return
+        self.loader.loaded.emit(self.generation, conversation, html)
+
+    def preview(self, html):
+        # False stops the load, nobody is waiting for it any more
+        if self.cancelled():
+            return False
+        self.loader.preview.emit(self.generation, html)
+        return True
+
+
+class PrefetchTask(QRunnable):
+    # warm the render cache for a conversation the user is likely to open next
+    def __init__(self, loader, generation, conversation_id):
+        super().__init__()
+        self.loader = loader
+        self.generation = generation
+        self.conversation_id = conversation_id
+
+    def cancelled(self):
+        return self.generation != self.loader.prefetch_generation
+
+    def run(self):
+        loader = self.loader
+        if self.cancelled() or loader.prefetched_bytes >= loader.prefetch_budget:
+            return
+        try:
+            conn = loader.database.get_thread_connection()
+            cursor = conn.cursor()
+            conversation = Conversation.get_by_id(self.conversation_id, cursor)
+            if self.cancelled() or loader.render_cache.get(conversation) != None:
+                return
+            # the ciphertext is a fair estimate of what the rendering will cost,
+            # don't start on something that blows the budget on its own.
+            # a conversation stored per message only has its marker in data
+            if is_messages_marker(conversation.data):
+                size = Message.data_size(conversation.id, cursor)
+            else:
+                size = len(conversation.data)
+            if size > loader.prefetch_budget - loader.prefetched_bytes:
+                return
+
+            wrapper = EncryptionWrapper.get(loader.password, conversation.salt, conversation.kdf)
+            html = load_html(conversation, wrapper, loader.render_cache, conn)
+        except Exception:
+            # prefetching is best effort, the real load will report the problem
+            return
+        loader.prefetched_bytes += sys.getsizeof(html)
+
+
+class ConversationLoader(QObject):
+    # fetch, decrypt and render conversations on a thread pool.
+    # every request bumps the generation, results from older requests are dropped
+    # by whoever listens, and tasks still queued or between stages give up early.
+    # html goes through as object, a QString round trip would copy it twice
+    loaded = Signal(int, object, object)
+    failed = Signal(int, str)
+    # the first screen of a big conversation, loaded follows with all of it
+    preview = Signal(int, object)
+
+    def __init__(self, password, render_cache, database, parent=None):
+        super().__init__(parent)
+        self.password = password
+        self.render_cache = render_cache
+        self.database = database
+        self.generation = 0
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(2)
+
+        # prefetching gets its own single thread so it never holds up a click
+        self.prefetch_generation = 0
+        self.prefetch_budget = 16 * 1024 * 1024
+        self.prefetched_bytes = 0
+        self.prefetch_pool = QThreadPool()
+        self.prefetch_pool.setMaxThreadCount(1)
+
+    def load(self, conversation_id):
+        self.cancel()
+        self.pool.start(LoadTask(self, self.generation, conversation_id=conversation_id))
+        return self.generation
+
+    def show(self, conversation):
+        # conversation already in memory, e.g. the active one after an edit
+        self.cancel()
+        self.pool.start(LoadTask(self, self.generation, conversation=conversation))
+        return self.generation
+
+    def prefetch(self, conversation_ids):
+        self.cancel_prefetch()
+        self.prefetched_bytes = 0
+        for conversation_id in conversation_ids:
+            self.prefetch_pool.start(PrefetchTask(self, self.prefetch_generation, conversation_id))
+
+    def cancel(self):
+        self.generation += 1
+        self.pool.clear()
+        # the user moved on, what we were guessing at is stale too
+        self.cancel_prefetch()
+
+    def cancel_prefetch(self):
+        self.prefetch_generation += 1
+        self.prefetch_pool.clear()
+
+    def is_current(self, generation):
+        return generation == self.generation
+
+    def stop(self):
+        self.cancel()
+        self.pool.waitForDone()
+        self.prefetch_pool.waitForDone()